@@ -1,50 +1,378 @@
-from fastapi import APIRouter, File, UploadFile, HTTPException, status
-from typing import List
-from app.schemas import UploadGradesResponse, StudentGradeCount
-from app.services.grade_service import GradeService
-from app.utils.validators import validate_csv_file
+import asyncio
+from datetime import date
+from fastapi import APIRouter, File, Query, Response, UploadFile, HTTPException, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import Dict, List, Literal, Optional, Tuple
+from app.config import get_settings
+from app.database import connection_scope
+from app.schemas import (
+    UploadGradesResponse, BatchUploadResponse, BatchFileResult, StudentGradeCount, StudentGradeCounts, CacheStats, UploadJobStatus
+)
+from app.services.analytics_cache import analytics_cache
+from app.services.grade_service import GradeService, JsonPage
+from app.services.upload_jobs import upload_jobs, get_upload_job
+from app.services.upload_ledger import DuplicateUploadError, hash_upload, find_upload
+from app.utils.archives import upload_kind, iter_batch_files
+from app.utils.columnar import COLUMNAR_CONTENT_TYPES, columnar_kind, iter_columnar_batches
+from app.utils.compression import COMPRESSED_CONTENT_TYPES, iter_upload_content, strip_encoding_suffix, upload_encoding
+from app.utils.pagination import encode_cursor, decode_cursor, iter_ndjson
+from app.utils.validators import check_filename, iter_grade_batches
 
 
 router = APIRouter(prefix='/api', tags=['grades'])
 
+PAGE_SIZE_MAX = get_settings().PAGE_SIZE_MAX
+
+
+def parse_cursor(cursor: Optional[str]) -> Optional[Tuple[int, str]]:
+    if cursor is None:
+        return None
+    try:
+        return decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(
+            status_code = status.HTTP_400_BAD_REQUEST,
+            detail = str(e)
+        )
+
+
+def json_page_response(page: JsonPage, limit: Optional[int]) -> Response:
+    # тело уже готовый JSON из базы: повторной валидации по response_model и кодирования нет,
+    # а response_model у маршрутов остаётся ради схемы OpenAPI.
+    # полная страница - возможно есть следующая; курсор в заголовке, тело остаётся списком
+    headers = {}
+    if limit is not None and page.rows == limit:
+        headers['X-Next-Cursor'] = encode_cursor(*page.last)
+    return Response(content = page.body, media_type = 'application/json', headers = headers)
+
 
 @router.post(
     '/upload-grades',
     response_model = UploadGradesResponse,
     status_code = status.HTTP_200_OK,
+    responses = {status.HTTP_202_ACCEPTED: {'model': UploadJobStatus}},
 )
-async def upload_grades(file: UploadFile = File(...)) -> UploadGradesResponse:
-    if file.content_type not in ['text/csv', 'application/vnd.ms-excel']: # application/vnd.ms-excel
+async def upload_grades(
+    file: UploadFile = File(...),
+    mode: Literal['sync', 'async'] = 'sync',
+) -> UploadGradesResponse:
+    try:
+        # Parquet/Arrow - по расширению имени, сжатие у них внутри формата;
+        # gzip/zstd для csv: по заголовку Content-Encoding части формы или по имени .csv.gz / .csv.zst
+        kind = columnar_kind(file.filename or '')
+        encoding = None if kind else upload_encoding(file.filename or '', file.headers.get('content-encoding'))
+    except ValueError as e:
+        raise HTTPException(
+            status_code = status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail = str(e)
+        )
+    content_types = ['text/csv', 'application/vnd.ms-excel'] # application/vnd.ms-excel
+    if kind:
+        content_types = COLUMNAR_CONTENT_TYPES
+    elif encoding:
+        content_types = content_types + list(COMPRESSED_CONTENT_TYPES)
+    if file.content_type not in content_types:
         raise HTTPException(
             status_code = status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
             detail = f'Unsupported file type'
         )
-    file_content = await file.read()
-    records, errors = await validate_csv_file(file_content, file.filename or '')
-    if errors:
+    filename = strip_encoding_suffix(file.filename or '')
+    settings = get_settings()
+    if mode == 'async':
+        try:
+            if kind is None:
+                check_filename(filename)
+            job = await upload_jobs.submit(file, encoding, kind)
+        except ValueError as e:
+            raise HTTPException(
+                status_code = status.HTTP_400_BAD_REQUEST,
+                detail = str(e)
+            )
+        except asyncio.QueueFull:
+            raise HTTPException(
+                status_code = status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail = 'Очередь загрузок переполнена, повторите позже'
+            )
+        return JSONResponse(status_code = status.HTTP_202_ACCEPTED, content = jsonable_encoder(job))
+    content_hash = None
+    try:
+        if kind is None:
+            check_filename(filename)
+        if settings.UPLOAD_DEDUP_ENABLED:
+            content_hash = await hash_upload(file, settings.UPLOAD_CHUNK_SIZE)
+        # проверка журнала и вся загрузка идут через одно соединение из пула
+        async with connection_scope():
+            if content_hash is not None:
+                # повтор того же файла (ретрай клиента) отвечает по журналу загрузок без парсинга
+                previous = await find_upload(content_hash)
+                if previous is not None:
+                    raise DuplicateUploadError(content_hash, previous['students'])
+            if kind is not None:
+                batches = iter_columnar_batches(file.file, kind, settings.INSERT_BATCH_SIZE)
+            else:
+                batches = iter_grade_batches(
+                    iter_upload_content(file, encoding, settings.UPLOAD_CHUNK_SIZE),
+                    settings.INSERT_BATCH_SIZE
+                )
+            result = await GradeService.load_grade_batches(
+                batches,
+                content_hash = content_hash,
+                filename = file.filename or '',
+            )
+    except DuplicateUploadError as e:
+        return UploadGradesResponse(
+            status = 'duplicate',
+            records_loaded = 0,
+            students = e.students or 0,
+            message = 'Файл уже был загружен, записи не добавлены',
+            content_hash = e.content_hash,
+        )
+    except ValueError as e:
         raise HTTPException(
             status_code = status.HTTP_400_BAD_REQUEST,
-            detail = f"На стадии парсинга ошибки: {';'.join(errors[:5])}"
+            detail = str(e)
         )
-    records_loaded, students_count = await GradeService.insert_grades(records)
     return UploadGradesResponse(
         status = 'ok',
-        records_loaded = records_loaded,
-        students = students_count,
-        message = f'Загруженны записи о {records_loaded} студентах'
+        records_loaded = result.records_loaded,
+        students = result.students,
+        file_students = result.file_students,
+        message = f'Загруженны записи о {result.file_students} студентах',
+        content_hash = content_hash,
+    )
+
+
+@router.post(
+    '/upload-grades/batch',
+    response_model = BatchUploadResponse,
+    status_code = status.HTTP_200_OK
+)
+async def upload_grades_batch(files: List[UploadFile] = File(...)) -> BatchUploadResponse:
+    # несколько csv и/или архивы zip, tar, tar.gz одним запросом и одной транзакцией.
+    # тип определяется по расширению: content-type архивов у клиентов слишком разный
+    settings = get_settings()
+    duplicates: List[BatchFileResult] = []
+    uploads: List[Tuple[UploadFile, Optional[str]]] = []
+    hashes: Dict[str, str] = {}
+    students = 0
+    try:
+        for file in files:
+            upload_kind(file.filename or '')
+        async with connection_scope():
+            for file in files:
+                content_hash = None
+                if settings.UPLOAD_DEDUP_ENABLED:
+                    content_hash = await hash_upload(file, settings.UPLOAD_CHUNK_SIZE)
+                    # дубль проверяется и внутри запроса: второй такой же файл упал бы на журнале и откатил пакет
+                    previous = None if content_hash in hashes else await find_upload(content_hash)
+                    if content_hash in hashes or previous is not None:
+                        students = max(students, previous['students'] if previous else 0)
+                        duplicates.append(BatchFileResult(
+                            filename = file.filename or '',
+                            status = 'duplicate',
+                            records = 0,
+                            content_hash = content_hash,
+                        ))
+                        continue
+                    hashes[content_hash] = file.filename or ''
+                uploads.append((file, content_hash))
+            if not uploads:
+                return BatchUploadResponse(
+                    status = 'duplicate',
+                    records_loaded = 0,
+                    students = students,
+                    files = duplicates,
+                    message = 'Файлы уже были загружены, записи не добавлены',
+                )
+            sources = (
+                (filename, content_hash, iter_grade_batches(chunks, settings.INSERT_BATCH_SIZE))
+                async for filename, content_hash, chunks in iter_batch_files(uploads, settings.UPLOAD_CHUNK_SIZE)
+            )
+            result = await GradeService.load_grade_files(sources, uploads = hashes)
+    except DuplicateUploadError as e:
+        # тот же файл параллельно загрузил другой запрос: пакет откатился целиком
+        return BatchUploadResponse(
+            status = 'duplicate',
+            records_loaded = 0,
+            students = e.students or 0,
+            files = [BatchFileResult(filename = hashes.get(e.content_hash, ''), status = 'duplicate', records = 0, content_hash = e.content_hash)],
+            message = 'Файл пакета уже был загружен, записи не добавлены',
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code = status.HTTP_400_BAD_REQUEST,
+            detail = str(e)
+        )
+    loaded = [
+        BatchFileResult(
+            filename = file.filename,
+            status = 'ok',
+            records = file.records,
+            file_students = file.file_students,
+            content_hash = file.content_hash,
+        )
+        for file in result.files
+    ]
+    return BatchUploadResponse(
+        status = 'ok',
+        records_loaded = result.records_loaded,
+        students = result.students,
+        file_students = result.file_students,
+        files = loaded + duplicates,
+        message = f'Загруженны записи о {result.file_students} студентах из {len(loaded)} файлов',
     )
 
 
+@router.get(
+    '/upload-jobs/{job_id}',
+    response_model = UploadJobStatus,
+    status_code = status.HTTP_200_OK
+)
+async def get_upload_job_status(job_id: str) -> UploadJobStatus:
+    job = await get_upload_job(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code = status.HTTP_404_NOT_FOUND,
+            detail = 'Задача загрузки не найдена'
+        )
+    return job
+
+
+@router.get(
+    '/students/grade-counts',
+    response_model = List[StudentGradeCounts],
+    status_code = status.HTTP_200_OK
+)
+async def get_grade_counts(
+    grade: Optional[int] = Query(None, ge = 1, le = 5),
+    min_count: Optional[int] = Query(None, alias = 'min', ge = 0),
+    max_count: Optional[int] = Query(None, alias = 'max', ge = 0),
+    group: Optional[str] = Query(None, min_length = 1, max_length = 255),
+    date_from: Optional[date] = Query(None, alias = 'from'),
+    date_to: Optional[date] = Query(None, alias = 'to'),
+    limit: Optional[int] = Query(None, ge = 1, le = PAGE_SIZE_MAX),
+    cursor: Optional[str] = None,
+    format: Literal['json', 'ndjson'] = 'json',
+) -> List[StudentGradeCounts]:
+    # счётчики по всем оценкам сразу, min/max относятся к оценке grade (по умолчанию GRADE_TO_ANALYZE)
+    grade = grade or get_settings().GRADE_TO_ANALYZE
+    params = dict(
+        grade = grade,
+        min_count = min_count,
+        max_count = max_count,
+        group = group,
+        date_from = date_from,
+        date_to = date_to,
+        limit = limit,
+        after = parse_cursor(cursor),
+    )
+    if format == 'ndjson':
+        return StreamingResponse(iter_ndjson(GradeService.stream_grade_counts(**params)), media_type = 'application/x-ndjson')
+    page = await GradeService.get_grade_counts_json(**params)
+    return json_page_response(page, limit)
+
+
 @router.get(
     '/students/more-than-3-twos',
     response_model = List[StudentGradeCount],
     status_code = status.HTTP_200_OK
 )
-async def get_students_with_more_than_3_twos() -> List[StudentGradeCount]:
-    students = await GradeService.get_students_with_more_than_n_twos(n = 3)
-    return students
+async def get_students_with_more_than_3_twos(
+    date_from: Optional[date] = Query(None, alias = 'from'),
+    date_to: Optional[date] = Query(None, alias = 'to'),
+    limit: Optional[int] = Query(None, ge = 1, le = PAGE_SIZE_MAX),
+    cursor: Optional[str] = None,
+    format: Literal['json', 'ndjson'] = 'json',
+) -> List[StudentGradeCount]:
+    after = parse_cursor(cursor)
+    if format == 'ndjson':
+        rows = GradeService.stream_students_with_twos(
+            min_count = 4, date_from = date_from, date_to = date_to, limit = limit, after = after
+        )
+        return StreamingResponse(iter_ndjson(rows), media_type = 'application/x-ndjson')
+    page = await GradeService.get_students_with_twos_json(
+        min_count = 4, date_from = date_from, date_to = date_to, limit = limit, after = after
+    )
+    return json_page_response(page, limit)
 
 @router.get('/students/less-than-5-twos')
-async def get_students_with_less_than_5_twos() -> List[StudentGradeCount]:
-    students = await GradeService.get_students_with_less_than_n_twos(n=5)
-    return students
+async def get_students_with_less_than_5_twos(
+    date_from: Optional[date] = Query(None, alias = 'from'),
+    date_to: Optional[date] = Query(None, alias = 'to'),
+    limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX),
+    cursor: Optional[str] = None,
+    format: Literal['json', 'ndjson'] = 'json',
+) -> List[StudentGradeCount]:
+    after = parse_cursor(cursor)
+    if format == 'ndjson':
+        rows = GradeService.stream_students_with_twos(
+            min_count=1, max_count=4, date_from=date_from, date_to=date_to, limit=limit, after=after
+        )
+        return StreamingResponse(iter_ndjson(rows), media_type='application/x-ndjson')
+    page = await GradeService.get_students_with_twos_json(
+        min_count=1, max_count=4, date_from=date_from, date_to=date_to, limit=limit, after=after
+    )
+    return json_page_response(page, limit)
+
+
+EXPORT_MEDIA_TYPES = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+
+
+class ExportResponse(StreamingResponse):
+    # starlette не закрывает итератор тела, если клиент отвалился посреди отправки: без aclose
+    # COPY так и ждал бы в очереди, держа соединение с бд, до сборки мусора
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+
+
+def export_response(name: str, export, format: str, **filters) -> StreamingResponse:
+    # ошибки до начала ответа (нет pyarrow) - отказом, дальше тело идёт потоком из COPY
+    try:
+        chunks = export(format, **filters)
+    except ValueError as e:
+        raise HTTPException(
+            status_code = status.HTTP_406_NOT_ACCEPTABLE,
+            detail = str(e)
+        )
+    return ExportResponse(
+        chunks,
+        media_type = EXPORT_MEDIA_TYPES[format],
+        headers = {'Content-Disposition': f'attachment; filename="{name}.{format}"'}
+    )
+
+
+@router.get('/export/grades', response_class = ExportResponse)
+async def export_grades(
+    group: Optional[str] = Query(None, min_length = 1, max_length = 255),
+    date_from: Optional[date] = Query(None, alias = 'from'),
+    date_to: Optional[date] = Query(None, alias = 'to'),
+    format: Literal['csv', 'parquet'] = 'csv',
+) -> StreamingResponse:
+    # все оценки в формате загрузки: Дата;Номер группы;ФИО;Оценка
+    return export_response('grades', GradeService.export_grades, format, group = group, date_from = date_from, date_to = date_to)
+
+
+@router.get('/export/student-stats', response_class = ExportResponse)
+async def export_student_stats(
+    group: Optional[str] = Query(None, min_length = 1, max_length = 255),
+    date_from: Optional[date] = Query(None, alias = 'from'),
+    date_to: Optional[date] = Query(None, alias = 'to'),
+    format: Literal['csv', 'parquet'] = 'csv',
+) -> StreamingResponse:
+    # счётчики оценок по каждому студенту: full_name;count_1;...;count_5;total
+    return export_response(
+        'student-stats', GradeService.export_student_stats, format, group = group, date_from = date_from, date_to = date_to
+    )
+
+
+@router.get(
+    '/cache/stats',
+    response_model = CacheStats,
+    status_code = status.HTTP_200_OK
+)
+async def get_cache_stats() -> CacheStats:
+    return CacheStats(**analytics_cache.stats())
@@ -1,27 +1,158 @@
+import asyncio
+import itertools
+import time
 import asyncpg
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from app.config import get_settings
-from typing import Optional, List, Tuple, Dict, Any
+from app.logger import get_logger
+from app.metrics import DB_POOL_ACQUIRE_DURATION, DB_POOL_CONNECTIONS, DB_QUERY_DURATION, DB_REPLICA_UP
+from app.utils.aio import iter_pushed
+from typing import Optional, List, Tuple, Dict, Any, AsyncIterator, Awaitable, Callable
 
 
+logger = get_logger('database')
+
 _pool: Optional[asyncpg.Pool] = None # глобал пул 
+_prepare: Optional[Callable[[asyncpg.Connection], Awaitable[None]]] = None
+# соединение, открытое connection_scope(): хелперы ниже берут его вместо своего из пула
+_scoped_conn: ContextVar[Optional[asyncpg.Connection]] = ContextVar('db_connection', default=None)
+_replicas: List['Replica'] = []
+_replica_checks: Optional[asyncio.Task] = None
+_round_robin = itertools.count()
+_primary_reads_until = 0.0
 
 
-async def init_db() -> asyncpg.Pool:
-    global _pool
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    # вызывается пулом один раз на каждое новое соединение, до первой выдачи
+    if _prepare is None:
+        return
+    try:
+        await _prepare(conn)
+    except asyncpg.PostgresError as e:
+        # без прогрева соединение рабочее, просто первые запросы подготовятся сами
+        logger.warning('Прогрев соединения не удался: %s', e)
+
+
+def _pool_options(application_name: str) -> Dict[str, Any]:
     settings = get_settings()
+    return dict(
+        min_size = settings.DB_POOL_MIN_SIZE,
+        max_size = settings.DB_POOL_MAX_SIZE,
+        statement_cache_size = settings.DB_STATEMENT_CACHE_SIZE,
+        max_cached_statement_lifetime = settings.DB_STATEMENT_LIFETIME,
+        max_inactive_connection_lifetime = settings.DB_MAX_INACTIVE_LIFETIME,
+        command_timeout = settings.DB_COMMAND_TIMEOUT,
+        init = _init_connection,
+        server_settings = {'application_name': application_name},
+    )
+
+
+async def init_db(prepare: Optional[Callable[[asyncpg.Connection], Awaitable[None]]] = None) -> asyncpg.Pool:
+    global _pool, _prepare
+    settings = get_settings()
+    _prepare = prepare
     _pool = await asyncpg.create_pool(
         host = settings.DB_HOST,
         port = settings.DB_PORT,
         user = settings.DB_USER,
         password = settings.DB_PASSWORD,
         database = settings.DB_NAME,
-        min_size = settings.DB_POOL_MIN_SIZE,
-        max_size = settings.DB_POOL_MAX_SIZE,
+        **_pool_options(settings.DB_APPLICATION_NAME),
     )
+    await init_replicas(settings.DB_REPLICA_DSNS)
     #print('pool created')
     return _pool
 
 
+class Replica:
+    def __init__(self, name: str, dsn: str):
+        self.name = name
+        self.dsn = dsn
+        self.pool: Optional[asyncpg.Pool] = None
+        self.healthy = False
+
+    async def check(self) -> None:
+        # пул создаётся при первой удачной проверке: реплика, лежавшая при старте, подключится позже
+        timeout = get_settings().DB_REPLICA_CHECK_TIMEOUT
+        try:
+            if self.pool is None:
+                self.pool = await asyncio.wait_for(asyncpg.create_pool(self.dsn, **_pool_options(self.name)), timeout)
+            async with self.pool.acquire(timeout=timeout) as conn:
+                await conn.fetchval('SELECT 1', timeout=timeout)
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            self.mark_down(e)
+            return
+        if not self.healthy:
+            logger.info('Реплика %s в работе', self.name)
+        self.healthy = True
+
+    def mark_down(self, error: Exception) -> None:
+        if self.healthy:
+            logger.warning('Реплика %s выведена из чтения: %s', self.name, error)
+        self.healthy = False
+
+    async def close(self) -> None:
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+
+async def _check_replicas(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.gather(*(replica.check() for replica in _replicas))
+
+
+async def init_replicas(dsns: List[str]) -> None:
+    global _replica_checks
+    settings = get_settings()
+    _replicas.extend(Replica(f'{settings.DB_APPLICATION_NAME}-replica-{i}', dsn) for i, dsn in enumerate(dsns))
+    if not _replicas:
+        return
+    await asyncio.gather(*(replica.check() for replica in _replicas))
+    _replica_checks = asyncio.create_task(_check_replicas(settings.DB_REPLICA_CHECK_INTERVAL))
+
+
+async def close_replicas() -> None:
+    global _replica_checks
+    if _replica_checks is not None:
+        _replica_checks.cancel()
+        await asyncio.gather(_replica_checks, return_exceptions=True)
+        _replica_checks = None
+    for replica in _replicas:
+        await replica.close()
+    _replicas.clear()
+
+
+def route_reads_to_primary() -> None:
+    # после записи реплики могут отставать: на время окна чтения идут на основной
+    global _primary_reads_until
+    window = get_settings().DB_READ_YOUR_WRITES_WINDOW
+    if window > 0:
+        _primary_reads_until = max(_primary_reads_until, time.monotonic() + window)
+
+
+def _next_replica() -> Optional[Replica]:
+    if not _replicas or time.monotonic() < _primary_reads_until:
+        return None
+    healthy = [replica for replica in _replicas if replica.healthy]
+    if not healthy:
+        return None
+    return healthy[next(_round_robin) % len(healthy)]
+
+
+async def connect() -> asyncpg.Connection:
+    settings = get_settings()
+    return await asyncpg.connect(
+        host = settings.DB_HOST,
+        port = settings.DB_PORT,
+        user = settings.DB_USER,
+        password = settings.DB_PASSWORD,
+        database = settings.DB_NAME,
+    )
+
+
 def get_pool():
     global _pool
     if _pool is None:
@@ -29,54 +160,130 @@ def get_pool():
     return _pool
 
 
+def _pool_connection_stats() -> Dict[Tuple[str, ...], float]:
+    if _pool is None:
+        return {}
+    size = _pool.get_size()
+    idle = _pool.get_idle_size()
+    return {('size',): size, ('idle',): idle, ('in_use',): size - idle, ('max',): _pool.get_max_size()}
+
+
+DB_POOL_CONNECTIONS.set_callback(_pool_connection_stats)
+DB_REPLICA_UP.set_callback(lambda: {(replica.name,): float(replica.healthy) for replica in _replicas})
+
+
+async def acquire(pool: asyncpg.Pool, name: str = 'primary') -> asyncpg.Connection:
+    started = time.perf_counter()
+    conn = await pool.acquire()
+    DB_POOL_ACQUIRE_DURATION.observe(time.perf_counter() - started, name)
+    return conn
+
+
 async def close_db() -> None:
-    global _pool
+    global _pool, _prepare
+    await close_replicas()
     if _pool is not None:
         await _pool.close()
         _pool = None
+        _prepare = None
         #print('pool closed')
 
 
-async def get_connection():
-    pool = get_pool()
-    conn = await pool.acquire()
+@asynccontextmanager
+async def connection(read_only: bool = False) -> AsyncIterator[asyncpg.Connection]:
+    # read_only - запрос можно отдать реплике; в области запроса всё идёт через её соединение
+    conn = _scoped_conn.get()
+    if conn is not None:
+        yield conn
+        return
+    replica = _next_replica() if read_only else None
+    if replica is not None:
+        try:
+            pool = replica.pool
+            conn = await acquire(pool, replica.name)
+        except (OSError, asyncpg.CannotConnectNowError) as e:
+            # до следующей удачной проверки реплика выпадает из круга, запрос уходит на основной
+            replica.mark_down(e)
+    if conn is None:
+        pool = get_pool()
+        conn = await acquire(pool)
     try:
         yield conn
     finally:
         await pool.release(conn)
 
 
-async def execute_query(query: str, *args) -> list:
+@asynccontextmanager
+async def connection_scope() -> AsyncIterator[asyncpg.Connection]:
+    # одно соединение на весь обработчик: запросы и transaction() внутри идут через него,
+    # вложенная transaction() становится точкой сохранения. параллельные задачи внутри области
+    # наследуют соединение, поэтому запросы из них в области выполнять нельзя
+    async with connection() as conn:
+        token = _scoped_conn.set(conn)
+        try:
+            yield conn
+        finally:
+            _scoped_conn.reset(token)
+
+
+async def get_connection():
     pool = get_pool()
-    conn = await pool.acquire()
+    conn = await acquire(pool)
     try:
-        return await conn.fetch(query, *args)
+        yield conn
     finally:
-        await get_pool().release(conn)
+        await pool.release(conn)
+
+
+@asynccontextmanager
+async def transaction():
+    async with connection() as conn:
+        async with conn.transaction():
+            yield conn
+
+
+async def execute_query(query: str, *args, read_only: bool = False) -> list:
+    async with connection(read_only) as conn:
+        with DB_QUERY_DURATION.time('execute_query'):
+            return await conn.fetch(query, *args)
 
     
 async def execute_update(query: str, *args) -> str:
-    pool = get_pool()
-    conn = await pool.acquire()
-    try:
-        return await conn.execute(query, *args)
-    finally:
-        await get_pool().release(conn)
+    async with connection() as conn:
+        with DB_QUERY_DURATION.time('execute_update'):
+            return await conn.execute(query, *args)
 
 
 async def execute_many(query: str, args_list: list) -> None:
-    pool = get_pool()
-    conn = await pool.acquire()
-    try:
-        await conn.executemany(query, args_list)
-    finally:
-        await get_pool().release(conn)
+    async with connection() as conn:
+        with DB_QUERY_DURATION.time('execute_many'):
+            await conn.executemany(query, args_list)
 
 
 async def execute_query_single(query: str, *args):
-    conn = await get_pool().acquire()
-    try:
-        result = await conn.fetchrow(query, *args)
+    async with connection() as conn:
+        with DB_QUERY_DURATION.time('execute_query_single'):
+            result = await conn.fetchrow(query, *args)
         return dict(result) if result else None
-    finally:
-        await get_pool().release(conn)
\ No newline at end of file
+
+
+async def iter_query(query: str, *args, prefetch: int = 1000, read_only: bool = False) -> AsyncIterator[asyncpg.Record]:
+    # серверный курсор живёт только внутри транзакции, соединение занято до конца чтения
+    async with connection(read_only) as conn:
+        async with conn.transaction():
+            async for record in conn.cursor(query, *args, prefetch=prefetch):
+                yield record
+
+def copy_query(query: str, *args, depth: int = 4, read_only: bool = False, **options) -> AsyncIterator[bytes]:
+    # COPY (query) TO STDOUT: куски идут как пришли из сокета, строки в asyncpg не разбираются. пока потребитель
+    # не забрал куски из очереди, asyncpg не читает сокет и сервер упирается в буфер - память не растёт
+    async def run(put: Callable[[bytes], Awaitable[None]]) -> None:
+        # asyncpg отдаёт bytearray, а StreamingResponse принимает только bytes и str
+        async def output(data: bytearray) -> None:
+            await put(bytes(data))
+
+        async with connection(read_only) as conn:
+            with DB_QUERY_DURATION.time('copy_query'):
+                await conn.copy_from_query(query, *args, output=output, **options)
+
+    return iter_pushed(run, depth)
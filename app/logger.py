@@ -0,0 +1,57 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from typing import Optional
+from app.config import get_settings
+
+
+LOGGER_NAME = 'app'
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f'{LOGGER_NAME}.{name}')
+
+
+class JsonFormatter(logging.Formatter):
+    # одна запись - одна строка JSON, поля из extra={'fields': {...}} идут на верхний уровень
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging() -> None:
+    global _listener
+    if _listener is not None:
+        return
+    # обработчик в event loop только кладёт запись в очередь, запись в stdout идёт в отдельном потоке
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    logger.setLevel(logging.DEBUG if get_settings().DEBUG else logging.INFO)
+    logger.propagate = False
+
+
+def shutdown_logging() -> None:
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
+    logging.getLogger(LOGGER_NAME).handlers = []
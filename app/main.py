@@ -1,15 +1,65 @@
+import time
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from app.database import init_db, close_db
 from app.config import get_settings
+from app.logger import setup_logging, shutdown_logging
 from app.api.routes import router
+from app import metrics
+from app.services.grade_merge import check_natural_key
+from app.services.grade_service import GradeService
+from app.services.partitions import ensure_term_partitions
+from app.services.invalidation import start_invalidation_listener, stop_invalidation_listener
+from app.services.upload_jobs import upload_jobs
+from app.utils.executors import warm_up_parse_executor, shutdown_parse_executor
+
+
+class RequestMetricsMiddleware:
+    # чистый ASGI, а не @app.middleware: у потоковых ответов (выгрузки, ndjson) call_next возвращается
+    # после заголовков, и в гистограмму попадало бы время до первого байта, а не до последнего
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_measured(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_measured)
+        finally:
+            # приложение вернулось после сообщения с more_body=False либо с ошибкой;
+            # шаблон пути, а не сам путь, иначе id задач раздуют число серий
+            route = scope.get('route')
+            path = route.path if route is not None else 'unmatched'
+            metrics.HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, scope['method'], path, str(status_code))
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await init_db()
+    setup_logging()
+    await init_db(prepare = GradeService.prepare_connection)
+    await check_natural_key()
+    await ensure_term_partitions()
+    await start_invalidation_listener()
+    await warm_up_parse_executor()
+    upload_jobs.start()
     yield
+    await upload_jobs.stop()
+    shutdown_parse_executor()
+    await stop_invalidation_listener()
     await close_db()
+    shutdown_logging()
 
 
 def create_app() -> FastAPI:
@@ -24,6 +74,13 @@ def create_app() -> FastAPI:
     )
     app.include_router(router)
 
+    if settings.METRICS_ENABLED:
+        app.add_middleware(RequestMetricsMiddleware)
+
+        @app.get('/metrics', include_in_schema = False)
+        async def get_metrics():
+            return PlainTextResponse(metrics.render_metrics(), media_type = 'text/plain; version=0.0.4')
+
     @app.get('/health')
     async def health_check():
         return {'status': 'healthy', 'version': settings.API_VERSION}
@@ -0,0 +1,146 @@
+import bisect
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from app.config import get_settings
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# проверка флага - единственная цена метрик, когда они выключены
+enabled = get_settings().METRICS_ENABLED
+_registry: List['_Metric'] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric(ABC):
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    @abstractmethod
+    def samples(self) -> Iterator[str]:
+        ...
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, *labels: str) -> None:
+        if enabled:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for labels, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {value}'
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        callback: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._callback = callback
+
+    def set_callback(self, callback: Callable[[], Dict[Tuple[str, ...], float]]) -> None:
+        self._callback = callback
+
+    def set(self, value: float, *labels: str) -> None:
+        if enabled:
+            self._values[labels] = value
+
+    def samples(self) -> Iterator[str]:
+        values = self._callback() if self._callback is not None else self._values
+        for labels, value in values.items():
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {value}'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        if not enabled:
+            return
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def _timer(self, labels: Tuple[str, ...]) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def time(self, *labels: str):
+        return self._timer(labels) if enabled else nullcontext()
+
+    def samples(self) -> Iterator[str]:
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}'
+            le = 'le="+Inf"'
+            yield f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {count}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, labels)} {total}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}'
+
+
+def render_metrics() -> str:
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', 'Время обработки HTTP запроса', ('method', 'path', 'status')
+)
+UPLOAD_STAGE_DURATION = Histogram(
+    'upload_stage_duration_seconds', 'Время стадий загрузки: read, decode, parse, validate, insert, count_students', ('stage',)
+)
+UPLOAD_ROWS = Counter('upload_rows_total', 'Загруженные строки оценок')
+UPLOAD_ROWS_PER_SECOND = Gauge('upload_rows_per_second', 'Скорость последней успешной загрузки')
+DB_QUERY_DURATION = Histogram('db_query_duration_seconds', 'Время запросов через хелперы app.database', ('helper',))
+DB_POOL_ACQUIRE_DURATION = Histogram('db_pool_acquire_seconds', 'Ожидание свободного соединения в пуле', ('pool',))
+DB_POOL_CONNECTIONS = Gauge('db_pool_connections', 'Соединения пула по состоянию', ('state',))
+DB_REPLICA_UP = Gauge('db_replica_up', 'Реплика для чтения в круге (1) или выведена из него (0)', ('replica',))
@@ -1,20 +1,83 @@
 from pydantic import BaseModel, Field
-from typing import Optional
+from datetime import date, datetime
+from typing import List, Optional
+
+
+MAX_NAME_LENGTH = 255
 
 
 class GradeRecord(BaseModel):
-    full_name: str = Field(..., min_length=1, max_length=255)
-    subject: str = Field(..., min_length=1, max_length=255)
+    full_name: str = Field(..., min_length=1, max_length=MAX_NAME_LENGTH)
+    subject: str = Field(..., min_length=1, max_length=MAX_NAME_LENGTH)
     grade: int = Field(..., ge=1, le=5)
+    grade_date: Optional[date] = None
 
 
 class UploadGradesResponse(BaseModel):
     status: str
     records_loaded: int
     students: int
+    file_students: Optional[int] = None
+    message: Optional[str] = None
+    content_hash: Optional[str] = None
+
+
+class BatchFileResult(BaseModel):
+    filename: str
+    status: str
+    records: int
+    file_students: Optional[int] = None
+    content_hash: Optional[str] = None
+
+
+class BatchUploadResponse(BaseModel):
+    status: str
+    records_loaded: int
+    students: int
+    file_students: Optional[int] = None
+    files: List[BatchFileResult]
     message: Optional[str] = None
 
 
+class UploadJobStatus(BaseModel):
+    job_id: str
+    status: str
+    filename: str
+    rows_parsed: int
+    rows_inserted: int
+    students: Optional[int] = None
+    file_students: Optional[int] = None
+    errors: List[str] = []
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    duration_seconds: Optional[float] = None
+    rows_per_second: Optional[float] = None
+
+
 class StudentGradeCount(BaseModel):
     full_name: str
-    twos_count: int
\ No newline at end of file
+    twos_count: int
+
+
+class StudentGradeCounts(BaseModel):
+    full_name: str
+    count_1: int
+    count_2: int
+    count_3: int
+    count_4: int
+    count_5: int
+    total: int
+
+    def count(self, grade: int) -> int:
+        return getattr(self, f'count_{grade}')
+
+
+class CacheStats(BaseModel):
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+    max_size: int
+    generation: int
+    hit_ratio: float
\ No newline at end of file
@@ -0,0 +1,66 @@
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+from app.config import get_settings
+
+
+class AnalyticsCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: 'OrderedDict[Hashable, Tuple[int, float, Any]]' = OrderedDict()
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            generation, expires_at, value = entry
+            if generation == self.generation and expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self._entries[key]
+        self.misses += 1
+        return False, None
+
+    def set(self, key: Hashable, value: Any, generation: int) -> None:
+        # пока шёл запрос в бд, могла закоммититься загрузка - такой результат уже устарел
+        if generation != self.generation or self.max_size <= 0:
+            return
+        self._entries[key] = (generation, time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        found, value = self.get(key)
+        if found:
+            return value
+        generation = self.generation
+        value = await loader()
+        self.set(key, value, generation)
+        return value
+
+    def invalidate(self) -> None:
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'generation': self.generation,
+            'hit_ratio': self.hits / requests if requests else 0.0,
+        }
+
+
+_settings = get_settings()
+analytics_cache = AnalyticsCache(_settings.ANALYTICS_CACHE_SIZE, _settings.ANALYTICS_CACHE_TTL)
@@ -0,0 +1,76 @@
+import io
+import asyncpg
+from typing import Awaitable, Callable, List, Optional, Sequence
+from app.config import get_settings
+
+
+GRADE_COLUMNS = ('student_id', 'group_id', 'grade', 'grade_date')
+
+
+class BulkLoader:
+    def __init__(
+        self,
+        conn: asyncpg.Connection,
+        table: str = 'grades',
+        columns: Sequence[str] = GRADE_COLUMNS,
+        batch_size: Optional[int] = None,
+        min_copy_rows: Optional[int] = None,
+        on_write: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        settings = get_settings()
+        self.conn = conn
+        self.table = table
+        self.columns = list(columns)
+        self.batch_size = batch_size or settings.BULK_COPY_BATCH_SIZE
+        self.min_copy_rows = settings.BULK_COPY_MIN_ROWS if min_copy_rows is None else min_copy_rows
+        self.on_write = on_write
+        self.rows_loaded = 0
+        self._buffer: List[list] = [[] for _ in self.columns]
+        self._copied = False
+        placeholders = ', '.join(f'${i}' for i in range(1, len(self.columns) + 1))
+        self._insert_query = f'INSERT INTO {table} ({", ".join(self.columns)}) VALUES ({placeholders})'
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buffer[0])
+
+    async def add(self, columns: Sequence[Sequence]) -> None:
+        # данные приходят и копятся колонками, кортежи строк собирает zip уже внутри COPY
+        for buffer, column in zip(self._buffer, columns):
+            buffer.extend(column)
+        while self.buffered >= self.batch_size:
+            batch = [buffer[:self.batch_size] for buffer in self._buffer]
+            for buffer in self._buffer:
+                del buffer[:self.batch_size]
+            await self._copy(batch)
+
+    async def flush(self) -> int:
+        batch, self._buffer = self._buffer, [[] for _ in self.columns]
+        size = len(batch[0])
+        if not size:
+            return self.rows_loaded
+        # на паре строк COPY дороже обычного insert, но только если COPY ещё не запускался
+        if not self._copied and size < self.min_copy_rows:
+            await self.conn.executemany(self._insert_query, list(zip(*batch)))
+            self.rows_loaded += size
+            if self.on_write is not None:
+                await self.on_write()
+        else:
+            await self._copy(batch)
+        return self.rows_loaded
+
+    async def copy_csv(self, data: bytes, rows: int) -> None:
+        # готовый csv без заголовка в порядке self.columns уходит в COPY как есть, без кортежей строк в python
+        await self.flush()
+        await self.conn.copy_to_table(self.table, source=io.BytesIO(data), columns=self.columns, format='csv')
+        self._copied = True
+        self.rows_loaded += rows
+        if self.on_write is not None:
+            await self.on_write()
+
+    async def _copy(self, batch: List[list]) -> None:
+        await self.conn.copy_records_to_table(self.table, records=zip(*batch), columns=self.columns)
+        self._copied = True
+        self.rows_loaded += len(batch[0])
+        if self.on_write is not None:
+            await self.on_write()
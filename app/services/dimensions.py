@@ -0,0 +1,43 @@
+import asyncpg
+from typing import Dict, List, Sequence
+
+
+class DimensionCache:
+    # словарь имя -> id на одну загрузку: в бд одним запросом уходят только имена, которых ещё нет в словаре
+    def __init__(self, conn: asyncpg.Connection, table: str, column: str):
+        self.conn = conn
+        self.ids: Dict[str, int] = {}
+        self.created = 0
+        self._resolve_query = f'''
+            WITH names AS (
+                SELECT unnest($1::varchar[]) AS {column}
+            ),
+            inserted AS (
+                INSERT INTO {table} ({column})
+                SELECT {column} FROM names
+                ON CONFLICT ({column}) DO NOTHING
+                RETURNING id, {column}
+            )
+            SELECT id, {column} AS name, true AS created FROM inserted
+            UNION ALL
+            SELECT t.id, t.{column} AS name, false AS created FROM {table} t JOIN names USING ({column})
+        '''
+        self._select_query = f'SELECT id, {column} AS name FROM {table} WHERE {column} = ANY($1::varchar[])'
+
+    async def resolve(self, names: Sequence[str]) -> List[int]:
+        missing = set(names).difference(self.ids)
+        if missing:
+            await self._load(sorted(missing))
+        ids = self.ids
+        return [ids[name] for name in names]
+
+    async def _load(self, names: List[str]) -> None:
+        # сортировка даёт одинаковый порядок блокировок у параллельных загрузок
+        rows = await self.conn.fetch(self._resolve_query, names)
+        if len(rows) < len(names):
+            # имя добавила параллельная загрузка: ON CONFLICT дождался её коммита, но снимок запроса строку не видит
+            known = {row['name'] for row in rows}
+            rows += await self.conn.fetch(self._select_query, [name for name in names if name not in known])
+        for row in rows:
+            self.ids[row['name']] = row['id']
+            self.created += row.get('created', False)
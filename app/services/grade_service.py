@@ -1,63 +1,521 @@
-from app.database import execute_query, execute_many, execute_query_single
-from typing import List, Tuple
-from app.schemas import GradeRecord, StudentGradeCount
+import time
+import asyncpg
+import orjson
+from app.config import get_settings
+from app.database import copy_query, execute_query, iter_query, transaction
+from app.metrics import UPLOAD_ROWS, UPLOAD_ROWS_PER_SECOND, UPLOAD_STAGE_DURATION
+from app.services.analytics_cache import analytics_cache
+from app.services.grade_merge import GradeMerger
+from app.services.grade_stats import GRADE_VALUES
+from app.services.invalidation import invalidate_local, notify_grades_changed
+from app.services.upload_ledger import record_upload
+from app.utils.aio import merge, prefetch
+from app.utils.columnar import check_parquet, iter_parquet
+from app.utils.validators import GradeColumns
+from datetime import date
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+from app.schemas import GradeRecord, StudentGradeCount, StudentGradeCounts
+
+
+MAX_COUNT = 2 ** 31 - 1
+# (колонка, тип arrow) для выгрузки в parquet; в csv заголовок приходит из запроса
+GRADES_EXPORT_COLUMNS = (('Дата', 'date32'), ('Номер группы', 'string'), ('ФИО', 'string'), ('Оценка', 'int16'))
+STUDENT_STATS_EXPORT_COLUMNS = (
+    ('full_name', 'string'), *((f'count_{value}', 'int64') for value in GRADE_VALUES), ('total', 'int64')
+)
+
+# число студентов держит счётчик, который растёт на новых студентов файла, без COUNT(DISTINCT) по grades
+COUNT_STUDENTS_QUERY = '''
+    UPDATE student_counter SET total = total + $1
+    RETURNING total
+'''
+
+
+def build_grade_filters(
+    group: Optional[str],
+    date_from: Optional[date],
+    date_to: Optional[date],
+    param: Callable[[object], str],
+) -> List[str]:
+    conditions = []
+    for condition, value in (
+        ('group_id = (SELECT id FROM groups WHERE name = {})', group),
+        ('grade_date >= {}', date_from),
+        ('grade_date <= {}', date_to),
+    ):
+        if value is not None:
+            conditions.append(condition.format(param(value)))
+    return conditions
+
+
+def build_grade_counts_source(
+    grade: int,
+    group: Optional[str],
+    date_from: Optional[date],
+    date_to: Optional[date],
+    single: bool,
+    param: Callable[[object], str],
+) -> str:
+    # single - только счётчик самой оценки и только у студентов, у которых она есть:
+    # такие запросы читают частичные индексы по grade = 2 и count_2 > 0, а не все строки
+    if group is None and date_from is None and date_to is None:
+        if single:
+            return f'SELECT student_id, count_{grade} FROM student_grade_stats WHERE count_{grade} > 0'
+        else:
+            columns = ', '.join(f'count_{value}' for value in GRADE_VALUES)
+            total = ' + '.join(f'count_{value}' for value in GRADE_VALUES)
+            return f'SELECT student_id, {columns}, {total} AS total FROM student_grade_stats'
+    else:
+        # с фильтрами считаем по grades за один проход; условия по дате отсекают лишние секции
+        conditions = [f'grade = {grade}'] if single else []
+        conditions += build_grade_filters(group, date_from, date_to, param)
+        if single:
+            counts = f'COUNT(*) AS count_{grade}'
+        else:
+            counts = ', '.join(f'COUNT(*) FILTER (WHERE grade = {value}) AS count_{value}' for value in GRADE_VALUES)
+            counts += ', COUNT(*) AS total'
+        return f'''
+            SELECT student_id, {counts}
+            FROM grades
+            WHERE {' AND '.join(conditions)}
+            GROUP BY student_id
+        '''
+
+
+def build_grade_counts_query(
+    grade: int,
+    group: Optional[str],
+    date_from: Optional[date],
+    date_to: Optional[date],
+    after: Optional[Tuple[int, str]] = None,
+    single: bool = False,
+) -> Tuple[str, list]:
+    # текст запроса зависит только от набора фильтров, значения идут параметрами:
+    # asyncpg держит подготовленные запросы в кэше соединения, вариантов немного и все они в него влезают.
+    # $1, $2 - границы min/max, $3 - limit (NULL = без ограничения), дальше курсор и фильтры
+    args: list = []
+
+    def param(value) -> str:
+        args.append(value)
+        return f'${len(args) + 3}'
+
+    source = build_grade_counts_source(grade, group, date_from, date_to, single, param)
+    # ФИО подтягиваются из students уже к посчитанным и отфильтрованным строкам, по одной на студента.
+    # keyset по порядку (count DESC, full_name ASC): следующая страница начинается строго после курсора
+    count = f'c.count_{grade}'
+    if single:
+        columns = count
+        nonempty = ''
+    else:
+        columns = ', '.join(f'c.count_{value}' for value in GRADE_VALUES) + ', c.total'
+        nonempty = 'AND c.total > 0'
+    keyset = ''
+    if after is not None:
+        last_count, last_name = param(after[0]), param(after[1])
+        keyset = f'AND ({count} < {last_count} OR ({count} = {last_count} AND s.full_name > {last_name}))'
+    return f'''
+        SELECT s.full_name, {columns}
+        FROM ({source}) c
+        JOIN students s ON s.id = c.student_id
+        WHERE {count} BETWEEN COALESCE($1::int, 0) AND COALESCE($2::int, {MAX_COUNT})
+            {nonempty}
+            {keyset}
+        ORDER BY {count} DESC, s.full_name ASC
+        LIMIT $3
+    ''', args
+
+
+def build_grades_export_query(
+    group: Optional[str],
+    date_from: Optional[date],
+    date_to: Optional[date],
+    date_format: str,
+) -> Tuple[str, list]:
+    # колонки и их порядок как в загружаемом csv. без ORDER BY: строки идут в порядке чтения секций,
+    # сервер не сортирует десятки миллионов строк и первые байты уходят клиенту сразу
+    args: list = []
+
+    def param(value) -> str:
+        args.append(value)
+        return f'${len(args)}'
+
+    conditions = build_grade_filters(group, date_from, date_to, param)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    return f'''
+        SELECT to_char(g.grade_date, '{date_format}') AS "Дата", gr.name AS "Номер группы",
+            s.full_name AS "ФИО", g.grade AS "Оценка"
+        FROM grades g
+        JOIN groups gr ON gr.id = g.group_id
+        JOIN students s ON s.id = g.student_id
+        {where}
+    ''', args
+
+
+def build_student_stats_export_query(
+    group: Optional[str],
+    date_from: Optional[date],
+    date_to: Optional[date],
+) -> Tuple[str, list]:
+    # те же счётчики, что у grade-counts, но по всем студентам и без сортировки
+    args: list = []
+
+    def param(value) -> str:
+        args.append(value)
+        return f'${len(args)}'
+
+    source = build_grade_counts_source(get_settings().GRADE_TO_ANALYZE, group, date_from, date_to, False, param)
+    columns = ', '.join(f'c.count_{value}' for value in GRADE_VALUES)
+    return f'''
+        SELECT s.full_name, {columns}, c.total
+        FROM ({source}) c
+        JOIN students s ON s.id = c.student_id
+        WHERE c.total > 0
+    ''', args
+
+
+def copy_export(query: str, args: list, format: str, columns: Sequence[Tuple[str, str]]) -> AsyncIterator[bytes]:
+    # COPY прямо в тело ответа: csv с заголовком как есть, parquet собирается из csv без заголовка
+    settings = get_settings()
+    chunks = copy_query(
+        query, *args, depth=settings.EXPORT_QUEUE_DEPTH, read_only=True, format='csv', delimiter=';', header=format == 'csv'
+    )
+    if format == 'csv':
+        return chunks
+    return iter_parquet(chunks, columns, settings.EXPORT_PARQUET_BLOCK_SIZE)
+
+
+class UploadResult(NamedTuple):
+    records_loaded: int
+    students: int
+    file_students: int
+
+
+class FileResult(NamedTuple):
+    filename: str
+    content_hash: Optional[str]
+    records: int
+    file_students: int
+
+
+class BatchResult(NamedTuple):
+    files: List[FileResult]
+    records_loaded: int
+    students: int
+    file_students: int
+
+
+async def with_filename(filename: str, batches: AsyncIterator[GradeColumns]) -> AsyncIterator[GradeColumns]:
+    # в пакете ошибка без имени файла бесполезна
+    try:
+        async for batch in batches:
+            yield batch
+    except ValueError as e:
+        raise ValueError(f'{filename}: {e}') from e
+
+
+class JsonPage(NamedTuple):
+    body: bytes
+    rows: int
+    last: Optional[Tuple[int, str]]
 
 
 class GradeService:
+    @staticmethod
+    async def prepare_connection(conn: asyncpg.Connection) -> None:
+        # горячие запросы аналитики выполняются с LIMIT 0: разбор и описание результата остаются
+        # в кэше подготовленных запросов соединения, первые запросы к api за них уже не платят
+        if not get_settings().DB_PREPARE_STATEMENTS:
+            return
+        grade = get_settings().GRADE_TO_ANALYZE
+        for single in (True, False):
+            query, _ = build_grade_counts_query(grade, None, None, None, single=single)
+            await conn.fetch(query, None, None, 0)
+
     @staticmethod
     async def insert_grades(records: List[GradeRecord]) -> Tuple[int, int]:
-        insert_data = [(record.full_name, record.subject, record.grade) for record in records]
-        insert_query = '''
-            INSERT INTO grades (full_name, subject, grade)
-            VALUES ($1, $2, $3)
-        '''
-        await execute_many(insert_query, insert_data)
-        count_student_query = '''
-            SELECT COUNT(DISTINCT full_name) as student_count
-            FROM grades
-        '''
-        result = await execute_query_single(count_student_query)
-        student_count = result['student_count']
-        return len(records), student_count
+        batch_size = get_settings().INSERT_BATCH_SIZE
+
+        async def batches() -> AsyncIterator[GradeColumns]:
+            for start in range(0, len(records), batch_size):
+                chunk = records[start:start + batch_size]
+                yield GradeColumns(
+                    [record.full_name for record in chunk],
+                    [record.subject for record in chunk],
+                    [record.grade for record in chunk],
+                    [record.grade_date for record in chunk],
+                )
+
+        return await GradeService.insert_grade_batches(batches())
 
     @staticmethod
-    async def get_students_with_more_than_n_twos(n: int = 3) -> List[StudentGradeCount]:
-        query = '''
-            SELECT 
-                full_name,
-                COUNT(*) as twos_count
-            FROM grades
-            WHERE grade = 2
-            GROUP BY full_name
-            HAVING COUNT(*) > $1
-            ORDER BY twos_count DESC, full_name ASC
-        '''
-        rows = await execute_query(query, n)
-        return [
-            StudentGradeCount(
-                full_name=row['full_name'],
-                twos_count=row['twos_count']
-            )
-            for row in rows
-        ]
+    async def insert_grade_batches(
+        batches: AsyncIterator[GradeColumns],
+        on_batch: Optional[Callable[[int], Awaitable[None]]] = None,
+        content_hash: Optional[str] = None,
+        filename: str = '',
+    ) -> Tuple[int, int]:
+        result = await GradeService.load_grade_batches(batches, on_batch, content_hash, filename)
+        return result.records_loaded, result.students
 
     @staticmethod
-    async def get_students_with_less_than_n_twos(n: int = 5) -> List[StudentGradeCount]:
-        query = '''
-            SELECT 
-                full_name,
-                COUNT(*) as twos_count
-            FROM grades
-            WHERE grade = 2
-            GROUP BY full_name
-            HAVING COUNT(*) < $1
-            ORDER BY twos_count DESC, full_name ASC
-        '''
-        rows = await execute_query(query, n)
-        return [
-            StudentGradeCount(
-                full_name=row['full_name'],
-                twos_count=row['twos_count']
-            )
-            for row in rows
+    async def load_grade_batches(
+        batches: AsyncIterator[GradeColumns],
+        on_batch: Optional[Callable[[int], Awaitable[None]]] = None,
+        content_hash: Optional[str] = None,
+        filename: str = '',
+    ) -> UploadResult:
+        settings = get_settings()
+        started = time.perf_counter()
+        # вся загрузка в одной транзакции: ошибка в конце файла откатывает уже вставленные батчи
+        async with transaction() as conn:
+            merger = GradeMerger(conn, settings.GRADES_ON_CONFLICT)
+            await merger.prepare()
+            async for batch in prefetch(batches, settings.INSERT_PREFETCH_BATCHES):
+                with UPLOAD_STAGE_DURATION.time('insert'):
+                    await merger.add(batch)
+                if on_batch is not None:
+                    await on_batch(merger.rows_staged)
+            with UPLOAD_STAGE_DURATION.time('insert'):
+                records_loaded = await merger.flush()
+            with UPLOAD_STAGE_DURATION.time('count_students'):
+                # счётчик обновляется последним: блокировка его строки держится только до коммита
+                students = await conn.fetchval(COUNT_STUDENTS_QUERY, merger.new_students)
+            if content_hash is not None:
+                await record_upload(conn, content_hash, filename, records_loaded, students)
+            if records_loaded:
+                await notify_grades_changed(conn)
+        if records_loaded:
+            invalidate_local()
+        UPLOAD_ROWS.inc(records_loaded)
+        UPLOAD_ROWS_PER_SECOND.set(records_loaded / (time.perf_counter() - started))
+        return UploadResult(records_loaded, students, len(merger.file_students))
+
+    @staticmethod
+    async def load_grade_files(
+        files: AsyncIterator[Tuple[str, Optional[str], AsyncIterator[GradeColumns]]],
+        uploads: Optional[Dict[str, str]] = None,
+    ) -> BatchResult:
+        # файлы пакета разбираются параллельно и сливаются через один GradeMerger в одной транзакции:
+        # общие COPY-батчи, один проход по счётчику студентов и одна инвалидация на весь пакет.
+        # files - (имя, хэш загруженного файла, батчи); uploads - хэш -> имя для журнала загрузок.
+        # одинаковые ключи из разных файлов пакета сливаются в порядке готовности батчей, а не файлов
+        settings = get_settings()
+        started = time.perf_counter()
+        names: List[Tuple[str, Optional[str]]] = []
+        records: List[int] = []
+        students: List[Set[str]] = []
+
+        async def sources() -> AsyncIterator[AsyncIterator[GradeColumns]]:
+            async for filename, content_hash, batches in files:
+                names.append((filename, content_hash))
+                records.append(0)
+                students.append(set())
+                yield with_filename(filename, batches)
+
+        async with transaction() as conn:
+            merger = GradeMerger(conn, settings.GRADES_ON_CONFLICT)
+            await merger.prepare()
+            batches = merge(sources(), settings.BATCH_PARSE_CONCURRENCY, settings.INSERT_PREFETCH_BATCHES)
+            async for index, batch in batches:
+                with UPLOAD_STAGE_DURATION.time('insert'):
+                    await merger.add(batch)
+                records[index] += len(batch.grade)
+                students[index].update(batch.full_name)
+            with UPLOAD_STAGE_DURATION.time('insert'):
+                records_loaded = await merger.flush()
+            with UPLOAD_STAGE_DURATION.time('count_students'):
+                total = await conn.fetchval(COUNT_STUDENTS_QUERY, merger.new_students)
+            for content_hash, filename in (uploads or {}).items():
+                loaded = sum(count for (_, file_hash), count in zip(names, records) if file_hash == content_hash)
+                await record_upload(conn, content_hash, filename, loaded, total)
+            if records_loaded:
+                await notify_grades_changed(conn)
+        if records_loaded:
+            invalidate_local()
+        UPLOAD_ROWS.inc(records_loaded)
+        UPLOAD_ROWS_PER_SECOND.set(records_loaded / (time.perf_counter() - started))
+        results = [
+            FileResult(filename, content_hash, count, len(file_students))
+            for (filename, content_hash), count, file_students in zip(names, records, students)
         ]
+        return BatchResult(results, records_loaded, total, len(merger.file_students))
+
+    @staticmethod
+    async def get_grade_counts(
+        grade: int,
+        min_count: Optional[int] = None,
+        max_count: Optional[int] = None,
+        group: Optional[str] = None,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[int, str]] = None,
+    ) -> List[StudentGradeCounts]:
+        # модели для вызовов из python собираются из той же страницы, что отдают роуты: один запрос и один кэш
+        page = await GradeService.get_grade_counts_json(
+            grade,
+            min_count=min_count,
+            max_count=max_count,
+            group=group,
+            date_from=date_from,
+            date_to=date_to,
+            limit=limit,
+            after=after,
+        )
+        return [StudentGradeCounts(**item) for item in orjson.loads(page.body)]
+
+    @staticmethod
+    async def get_grade_counts_json(
+        grade: int,
+        min_count: Optional[int] = None,
+        max_count: Optional[int] = None,
+        group: Optional[str] = None,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[int, str]] = None,
+        fields: Optional[Dict[str, str]] = None,
+        single: bool = False,
+    ) -> JsonPage:
+        # записи сразу кодируются orjson в тело ответа, минуя модели; в кэше лежат готовые байты
+        query, args = build_grade_counts_query(grade, group, date_from, date_to, after, single)
+
+        async def load() -> JsonPage:
+            rows = await execute_query(query, min_count, max_count, limit, *args, read_only=True)
+            if fields is None:
+                items = [dict(row) for row in rows]
+            else:
+                items = [{name: row[column] for name, column in fields.items()} for row in rows]
+            last = (rows[-1][f'count_{grade}'], rows[-1]['full_name']) if rows else None
+            return JsonPage(orjson.dumps(items), len(rows), last)
+
+        fields_key = tuple(fields.items()) if fields is not None else None
+        key = ('grade_counts_json', grade, min_count, max_count, group, date_from, date_to, limit, after, fields_key, single)
+        return await analytics_cache.get_or_load(key, load)
+
+    @staticmethod
+    async def stream_grade_counts(
+        grade: int,
+        min_count: Optional[int] = None,
+        max_count: Optional[int] = None,
+        group: Optional[str] = None,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[int, str]] = None,
+        single: bool = False,
+    ) -> AsyncIterator[dict]:
+        # без кэша и без списка в памяти: строки читаются серверным курсором порциями
+        query, args = build_grade_counts_query(grade, group, date_from, date_to, after, single)
+        prefetch = get_settings().STREAM_PREFETCH_ROWS
+        async for row in iter_query(query, min_count, max_count, limit, *args, prefetch=prefetch, read_only=True):
+            yield dict(row)
+
+    @staticmethod
+    async def get_students_with_twos_json(
+        min_count: Optional[int] = None,
+        max_count: Optional[int] = None,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[int, str]] = None,
+    ) -> JsonPage:
+        grade = get_settings().GRADE_TO_ANALYZE
+        return await GradeService.get_grade_counts_json(
+            grade,
+            min_count=min_count,
+            max_count=max_count,
+            date_from=date_from,
+            date_to=date_to,
+            limit=limit,
+            after=after,
+            fields={'full_name': 'full_name', 'twos_count': f'count_{grade}'},
+            single=True,
+        )
+
+    @staticmethod
+    async def stream_students_with_twos(
+        min_count: Optional[int] = None,
+        max_count: Optional[int] = None,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[int, str]] = None,
+    ) -> AsyncIterator[dict]:
+        grade = get_settings().GRADE_TO_ANALYZE
+        rows = GradeService.stream_grade_counts(
+            grade,
+            min_count=min_count,
+            max_count=max_count,
+            date_from=date_from,
+            date_to=date_to,
+            limit=limit,
+            after=after,
+            single=True,
+        )
+        async for row in rows:
+            yield {'full_name': row['full_name'], 'twos_count': row[f'count_{grade}']}
+
+    @staticmethod
+    async def get_twos_counts(
+        min_count: Optional[int] = None,
+        max_count: Optional[int] = None,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[int, str]] = None,
+    ) -> List[StudentGradeCount]:
+        page = await GradeService.get_students_with_twos_json(
+            min_count=min_count, max_count=max_count, date_from=date_from, date_to=date_to, limit=limit, after=after
+        )
+        return [StudentGradeCount(**item) for item in orjson.loads(page.body)]
+
+    @staticmethod
+    async def get_students_with_more_than_n_twos(
+        n: int = 3,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[int, str]] = None,
+    ) -> List[StudentGradeCount]:
+        return await GradeService.get_twos_counts(
+            min_count=n + 1, date_from=date_from, date_to=date_to, limit=limit, after=after
+        )
+
+    @staticmethod
+    async def get_students_with_less_than_n_twos(
+        n: int = 5,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[int, str]] = None,
+    ) -> List[StudentGradeCount]:
+        return await GradeService.get_twos_counts(
+            min_count=1, max_count=n - 1, date_from=date_from, date_to=date_to, limit=limit, after=after
+        )
+
+    @staticmethod
+    def export_grades(
+        format: str,
+        group: Optional[str] = None,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+    ) -> AsyncIterator[bytes]:
+        # csv выгрузки загружается обратно как есть: те же колонки, даты ДД.ММ.ГГГГ; в parquet даты типом date
+        if format == 'parquet':
+            check_parquet()
+        date_format = 'DD.MM.YYYY' if format == 'csv' else 'YYYY-MM-DD'
+        query, args = build_grades_export_query(group, date_from, date_to, date_format)
+        return copy_export(query, args, format, GRADES_EXPORT_COLUMNS)
+
+    @staticmethod
+    def export_student_stats(
+        format: str,
+        group: Optional[str] = None,
+        date_from: Optional[date] = None,
+        date_to: Optional[date] = None,
+    ) -> AsyncIterator[bytes]:
+        if format == 'parquet':
+            check_parquet()
+        query, args = build_student_stats_export_query(group, date_from, date_to)
+        return copy_export(query, args, format, STUDENT_STATS_EXPORT_COLUMNS)
@@ -0,0 +1,53 @@
+import asyncpg
+from typing import Dict, List, Optional, Sequence
+
+
+GRADE_VALUES = (1, 2, 3, 4, 5)
+
+
+def count_grades(
+    student_ids: Sequence[int],
+    grades: Sequence[int],
+    counts: Optional[Dict[int, List[int]]] = None,
+) -> Dict[int, List[int]]:
+    # counts - уже накопленные счётчики, новые оценки добавляются к ним
+    if counts is None:
+        counts = {}
+    for student_id, grade in zip(student_ids, grades):
+        student = counts.get(student_id)
+        if student is None:
+            student = counts[student_id] = [0] * len(GRADE_VALUES)
+        student[grade - GRADE_VALUES[0]] += 1
+    return counts
+
+
+def count_grade_changes(
+    student_ids: Sequence[int],
+    old_grades: Sequence[Optional[int]],
+    new_grades: Sequence[int],
+) -> Dict[int, List[int]]:
+    # перезаписанная оценка снимается со старого значения и добавляется к новому
+    counts = count_grades(student_ids, new_grades)
+    for student_id, grade in zip(student_ids, old_grades):
+        if grade is not None:
+            counts[student_id][grade - GRADE_VALUES[0]] -= 1
+    return counts
+
+
+async def apply_grade_counts(conn: asyncpg.Connection, counts: Dict[int, List[int]]) -> None:
+    if not counts:
+        return
+    query = '''
+        INSERT INTO student_grade_stats AS s (student_id, count_1, count_2, count_3, count_4, count_5)
+        SELECT * FROM unnest($1::int[], $2::int[], $3::int[], $4::int[], $5::int[], $6::int[])
+        ON CONFLICT (student_id) DO UPDATE SET
+            count_1 = s.count_1 + EXCLUDED.count_1,
+            count_2 = s.count_2 + EXCLUDED.count_2,
+            count_3 = s.count_3 + EXCLUDED.count_3,
+            count_4 = s.count_4 + EXCLUDED.count_4,
+            count_5 = s.count_5 + EXCLUDED.count_5
+    '''
+    # сортировка даёт одинаковый порядок блокировок у параллельных загрузок
+    student_ids = sorted(counts)
+    columns = [[counts[student_id][i] for student_id in student_ids] for i in range(len(GRADE_VALUES))]
+    await conn.execute(query, student_ids, *columns)
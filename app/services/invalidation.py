@@ -0,0 +1,95 @@
+import asyncio
+import uuid
+import asyncpg
+from typing import Callable, List, Optional
+from app.config import get_settings
+from app.database import connect, route_reads_to_primary
+from app.services.analytics_cache import analytics_cache
+
+
+# id процесса в payload, чтобы воркер не сбрасывал кэш на собственное уведомление
+INSTANCE_ID = uuid.uuid4().hex
+
+# оценки изменились: сбросить кэш аналитики и на время окна read-your-writes читать с основного.
+# чужие загрузки приходят сюда же через NOTIFY, поэтому окно действует во всех воркерах
+_callbacks: List[Callable[[], None]] = [analytics_cache.invalidate, route_reads_to_primary]
+
+
+def register_invalidation_callback(callback: Callable[[], None]) -> None:
+    _callbacks.append(callback)
+
+
+def invalidate_local() -> None:
+    for callback in _callbacks:
+        callback()
+
+
+async def notify_grades_changed(conn: asyncpg.Connection) -> None:
+    # NOTIFY внутри транзакции уходит слушателям только после коммита
+    await conn.execute('SELECT pg_notify($1, $2)', get_settings().INVALIDATION_CHANNEL, INSTANCE_ID)
+
+
+class InvalidationListener:
+    def __init__(self, channel: str, reconnect_delay: float):
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._conn: Optional[asyncpg.Connection] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    async def start(self) -> None:
+        self._closing = False
+        await self._connect()
+
+    async def stop(self) -> None:
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self._conn is not None and not self._conn.is_closed():
+            await self._conn.close()
+        self._conn = None
+
+    async def _connect(self) -> None:
+        conn = await connect()
+        await conn.add_listener(self.channel, self._on_notify)
+        conn.add_termination_listener(self._on_terminated)
+        self._conn = conn
+
+    def _on_notify(self, conn, pid: int, channel: str, payload: str) -> None:
+        if payload != INSTANCE_ID:
+            invalidate_local()
+
+    def _on_terminated(self, conn) -> None:
+        if not self._closing:
+            self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        while not self._closing:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await self._connect()
+            except (OSError, asyncpg.PostgresError):
+                continue
+            # пока соединения не было, уведомления могли потеряться
+            invalidate_local()
+            return
+
+
+_listener: Optional[InvalidationListener] = None
+
+
+async def start_invalidation_listener() -> None:
+    global _listener
+    settings = get_settings()
+    if not settings.INVALIDATION_LISTENER_ENABLED:
+        return
+    _listener = InvalidationListener(settings.INVALIDATION_CHANNEL, settings.INVALIDATION_RECONNECT_DELAY)
+    await _listener.start()
+
+
+async def stop_invalidation_listener() -> None:
+    global _listener
+    if _listener is not None:
+        await _listener.stop()
+        _listener = None
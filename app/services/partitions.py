@@ -0,0 +1,97 @@
+import asyncpg
+from datetime import date
+from typing import List, Optional, Tuple
+from app.config import get_settings
+from app.database import transaction
+from app.logger import get_logger
+from app.services.grade_stats import GRADE_VALUES, apply_grade_counts
+from app.services.invalidation import invalidate_local, notify_grades_changed
+
+
+logger = get_logger('partitions')
+
+DEFAULT_PARTITION = 'grades_default'
+
+
+def term_start(day: date) -> date:
+    # осенний семестр с 1 сентября, весенний с 1 февраля
+    if day.month >= 9:
+        return date(day.year, 9, 1)
+    if day.month >= 2:
+        return date(day.year, 2, 1)
+    return date(day.year - 1, 9, 1)
+
+
+def next_term_start(start: date) -> date:
+    if start.month == 9:
+        return date(start.year + 1, 2, 1)
+    return date(start.year, 9, 1)
+
+
+def partition_name(start: date) -> str:
+    return f'grades_p{start.year}_{start.month:02d}'
+
+
+def term_bounds(day_from: date, day_to: date) -> List[Tuple[date, date]]:
+    bounds = []
+    start = term_start(day_from)
+    while start <= day_to:
+        end = next_term_start(start)
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+async def ensure_term_partitions(day: Optional[date] = None, terms_ahead: Optional[int] = None) -> List[str]:
+    # секции создаются заранее и вне транзакции загрузки: CREATE ... PARTITION OF блокирует всю таблицу
+    day = day or date.today()
+    if terms_ahead is None:
+        terms_ahead = get_settings().PARTITION_TERMS_AHEAD
+    last = term_start(day)
+    for _ in range(terms_ahead):
+        last = next_term_start(last)
+    created = []
+    for start, end in term_bounds(day, last):
+        name = partition_name(start)
+        try:
+            async with transaction() as conn:
+                # воркеры gunicorn стартуют разом: без блокировки двое увидели бы, что секции нет,
+                # и второй CREATE упал бы на уже созданной. блокировка держится до коммита создавшего
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext('grades_partitions'))")
+                exists = await conn.fetchval('SELECT to_regclass($1) IS NOT NULL', name)
+                if exists:
+                    continue
+                await conn.execute(
+                    f"CREATE TABLE {name} PARTITION OF grades FOR VALUES FROM ('{start}') TO ('{end}')"
+                )
+        except asyncpg.CheckViolationError:
+            # строки этого семестра уже легли в секцию по умолчанию, переносить их здесь не будем
+            logger.warning('Секция %s не создана: в %s есть строки этого семестра', name, DEFAULT_PARTITION)
+            continue
+        created.append(name)
+    return created
+
+
+async def detach_term(start: date, drop: bool = False) -> int:
+    # вместо DELETE по миллионам строк секция отсоединяется целиком, статистика уменьшается на её счётчики
+    name = partition_name(term_start(start))
+    async with transaction() as conn:
+        if not await conn.fetchval('SELECT to_regclass($1) IS NOT NULL', name):
+            raise ValueError(f'Секция {name} не найдена')
+        # после DETACH блокировка на grades держится до коммита, новые строки семестра мимо подсчёта не пройдут
+        await conn.execute(f'ALTER TABLE grades DETACH PARTITION {name}')
+        rows = await conn.fetch(f'''
+            SELECT
+                student_id,
+                {', '.join(f'COUNT(*) FILTER (WHERE grade = {grade}) AS count_{grade}' for grade in GRADE_VALUES)}
+            FROM {name}
+            GROUP BY student_id
+        ''')
+        counts = {row['student_id']: [-row[f'count_{grade}'] for grade in GRADE_VALUES] for row in rows}
+        detached = -sum(sum(student) for student in counts.values())
+        await apply_grade_counts(conn, counts)
+        if drop:
+            await conn.execute(f'DROP TABLE {name}')
+        await notify_grades_changed(conn)
+    invalidate_local()
+    return detached
@@ -0,0 +1,229 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import uuid
+import aiofiles
+from dataclasses import dataclass
+from typing import AsyncIterator, List, Optional
+from fastapi import UploadFile
+from app.config import get_settings
+from app.database import execute_update, execute_query_single
+from app.logger import get_logger
+from app.metrics import UPLOAD_STAGE_DURATION
+from app.schemas import UploadJobStatus
+from app.services.grade_service import GradeService
+from app.services.upload_ledger import DuplicateUploadError, find_upload
+from app.utils.columnar import iter_columnar_batches
+from app.utils.compression import ENCODING_SUFFIXES, iter_decoded_chunks
+from app.utils.validators import GradeColumns, iter_upload_chunks, iter_grade_batches
+
+
+logger = get_logger('upload_jobs')
+
+
+@dataclass
+class UploadJob:
+    id: str
+    filename: str
+    path: str
+    content_hash: Optional[str] = None
+    encoding: Optional[str] = None
+    kind: Optional[str] = None
+    rows_parsed: int = 0
+    rows_inserted: int = 0
+    file_students: Optional[int] = None
+
+
+async def iter_file_chunks(path: str, chunk_size: int, encoding: Optional[str] = None) -> AsyncIterator[bytes]:
+    if encoding is not None:
+        # на диске файл лежит сжатым, распаковывается по мере разбора
+        with open(path, 'rb') as f:
+            async for chunk in iter_decoded_chunks(f, encoding, chunk_size):
+                yield chunk
+        return
+    async with aiofiles.open(path, 'rb') as f:
+        while True:
+            with UPLOAD_STAGE_DURATION.time('read'):
+                chunk = await f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def spool_suffix(kind: Optional[str], encoding: Optional[str]) -> str:
+    # расширение временного файла по содержимому: Parquet/Arrow и сжатый csv не выдаются за .csv
+    if kind is not None:
+        return f'.{kind}'
+    return '.csv' + next((suffix for suffix, value in ENCODING_SUFFIXES if value == encoding), '')
+
+
+async def get_upload_job(job_id: str) -> Optional[UploadJobStatus]:
+    query = '''
+        SELECT
+            id, status, filename, rows_parsed, rows_inserted, students, file_students, errors,
+            created_at, started_at, finished_at,
+            EXTRACT(EPOCH FROM COALESCE(finished_at, clock_timestamp()::timestamp) - started_at) AS duration_seconds
+        FROM upload_jobs
+        WHERE id = $1
+    '''
+    row = await execute_query_single(query, job_id)
+    if row is None:
+        return None
+    duration = float(row['duration_seconds']) if row['duration_seconds'] is not None else None
+    return UploadJobStatus(
+        job_id = row['id'],
+        status = row['status'],
+        filename = row['filename'],
+        rows_parsed = row['rows_parsed'],
+        rows_inserted = row['rows_inserted'],
+        students = row['students'],
+        file_students = row['file_students'],
+        errors = row['errors'],
+        created_at = row['created_at'],
+        started_at = row['started_at'],
+        finished_at = row['finished_at'],
+        duration_seconds = duration,
+        rows_per_second = row['rows_inserted'] / duration if duration else None,
+    )
+
+
+class UploadJobQueue:
+    def __init__(self, concurrency: int, max_queued: int):
+        self.concurrency = concurrency
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued)
+        # место в очереди занимается до записи файла и строки задачи: пока они пишутся, его не займёт другой запрос
+        self._reserved = 0
+        self._workers: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        while not self._queue.empty():
+            job = self._queue.get_nowait()
+            await self._finish(job, 'failed', None, ['Приложение остановлено до начала обработки'])
+
+    async def submit(self, file: UploadFile, encoding: Optional[str] = None, kind: Optional[str] = None) -> UploadJobStatus:
+        if self._queue.maxsize and self._queue.qsize() + self._reserved >= self._queue.maxsize:
+            raise asyncio.QueueFull()
+        self._reserved += 1
+        try:
+            job = await self._spool(file, encoding, kind)
+            self._queue.put_nowait(job)
+        finally:
+            self._reserved -= 1
+        return await get_upload_job(job.id)
+
+    async def _spool(self, file: UploadFile, encoding: Optional[str], kind: Optional[str]) -> UploadJob:
+        settings = get_settings()
+        # после ответа UploadFile закрывается, поэтому файл уходит во временный файл на диске
+        fd, path = tempfile.mkstemp(prefix='upload-', suffix=spool_suffix(kind, encoding))
+        os.close(fd)
+        digest = hashlib.sha256()
+        try:
+            async with aiofiles.open(path, 'wb') as f:
+                async for chunk in iter_upload_chunks(file, settings.UPLOAD_CHUNK_SIZE):
+                    digest.update(chunk)
+                    await f.write(chunk)
+            job = UploadJob(
+                id = uuid.uuid4().hex,
+                filename = file.filename or '',
+                path = path,
+                content_hash = digest.hexdigest() if settings.UPLOAD_DEDUP_ENABLED else None,
+                encoding = encoding,
+                kind = kind,
+            )
+            await execute_update(
+                "INSERT INTO upload_jobs (id, filename, status) VALUES ($1, $2, 'queued')",
+                job.id, job.filename
+            )
+        except BaseException:
+            os.unlink(path)
+            raise
+        return job
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: UploadJob) -> None:
+        settings = get_settings()
+        await execute_update(
+            "UPDATE upload_jobs SET status = 'running', started_at = clock_timestamp() WHERE id = $1",
+            job.id
+        )
+
+        async def counted(batches: AsyncIterator[GradeColumns]) -> AsyncIterator[GradeColumns]:
+            async for batch in batches:
+                job.rows_parsed += len(batch.grade)
+                yield batch
+
+        async def on_batch(rows_inserted: int) -> None:
+            job.rows_inserted = rows_inserted
+            await execute_update(
+                'UPDATE upload_jobs SET rows_parsed = $2, rows_inserted = $3 WHERE id = $1',
+                job.id, job.rows_parsed, job.rows_inserted
+            )
+
+        try:
+            if job.content_hash is not None:
+                previous = await find_upload(job.content_hash)
+                if previous is not None:
+                    raise DuplicateUploadError(job.content_hash, previous['students'])
+            if job.kind is not None:
+                # Parquet/Arrow читаются из временного файла через отображение в память
+                batches = iter_columnar_batches(job.path, job.kind, settings.INSERT_BATCH_SIZE)
+            else:
+                batches = iter_grade_batches(iter_file_chunks(job.path, settings.UPLOAD_CHUNK_SIZE, job.encoding), settings.INSERT_BATCH_SIZE)
+            result = await GradeService.load_grade_batches(
+                counted(batches),
+                on_batch = on_batch,
+                content_hash = job.content_hash,
+                filename = job.filename,
+            )
+            job.rows_inserted = result.records_loaded
+            job.file_students = result.file_students
+            await self._finish(job, 'done', result.students, [])
+        except DuplicateUploadError as e:
+            job.rows_inserted = 0
+            await self._finish(job, 'duplicate', e.students, [str(e)])
+        except ValueError as e:
+            # транзакция откатилась, в бд ничего не осталось
+            job.rows_inserted = 0
+            await self._finish(job, 'failed', None, [str(e)])
+        except asyncio.CancelledError:
+            job.rows_inserted = 0
+            await asyncio.shield(self._finish(job, 'failed', None, ['Обработка прервана остановкой приложения']))
+            raise
+        except Exception as e:
+            logger.exception('Загрузка %s упала', job.id)
+            job.rows_inserted = 0
+            await self._finish(job, 'failed', None, [f'Внутренняя ошибка: {e}'])
+
+    async def _finish(self, job: UploadJob, status: str, students: Optional[int], errors: List[str]) -> None:
+        try:
+            await execute_update(
+                '''
+                UPDATE upload_jobs
+                SET status = $2, rows_parsed = $3, rows_inserted = $4, students = $5, errors = $6,
+                    file_students = $7, finished_at = clock_timestamp()
+                WHERE id = $1
+                ''',
+                job.id, status, job.rows_parsed, job.rows_inserted, students, errors, job.file_students
+            )
+        finally:
+            if os.path.exists(job.path):
+                os.unlink(job.path)
+
+
+_settings = get_settings()
+upload_jobs = UploadJobQueue(_settings.UPLOAD_JOB_CONCURRENCY, _settings.UPLOAD_JOB_QUEUE_SIZE)
@@ -0,0 +1,53 @@
+import hashlib
+import asyncpg
+from typing import Optional
+from fastapi import UploadFile
+from app.database import execute_query_single
+
+
+class DuplicateUploadError(Exception):
+    def __init__(self, content_hash: str, students: Optional[int]):
+        super().__init__(f'Файл уже был загружен ({content_hash})')
+        self.content_hash = content_hash
+        self.students = students
+
+
+async def hash_upload(file: UploadFile, chunk_size: int) -> str:
+    # UploadFile уже лежит во временном файле, повторное чтение дешевле парсинга и вставки
+    digest = hashlib.sha256()
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+    await file.seek(0)
+    return digest.hexdigest()
+
+
+async def find_upload(content_hash: str) -> Optional[dict]:
+    return await execute_query_single(
+        'SELECT content_hash, filename, records_loaded, students FROM upload_ledger WHERE content_hash = $1',
+        content_hash
+    )
+
+
+async def record_upload(
+    conn: asyncpg.Connection,
+    content_hash: str,
+    filename: str,
+    records_loaded: int,
+    students: int,
+) -> None:
+    # запись идёт в транзакции загрузки: параллельная загрузка того же файла откатит одну из них
+    inserted = await conn.fetchval(
+        '''
+        INSERT INTO upload_ledger (content_hash, filename, records_loaded, students)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (content_hash) DO NOTHING
+        RETURNING true
+        ''',
+        content_hash, filename, records_loaded, students
+    )
+    if not inserted:
+        previous = await conn.fetchval('SELECT students FROM upload_ledger WHERE content_hash = $1', content_hash)
+        raise DuplicateUploadError(content_hash, previous)
@@ -0,0 +1,108 @@
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, List, Tuple, TypeVar
+
+
+T = TypeVar('T')
+_DONE = object()
+
+
+async def prefetch(source: AsyncIterator[T], depth: int) -> AsyncIterator[T]:
+    # источник крутится в отдельной таске, пока потребитель ждёт бд
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(depth, 1))
+
+    async def produce() -> None:
+        try:
+            async for item in source:
+                await queue.put(item)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(_DONE)
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+async def merge(sources: AsyncIterator[AsyncIterator[T]], concurrency: int, depth: int) -> AsyncIterator[Tuple[int, T]]:
+    # источники читаются параллельно, не больше concurrency разом; элементы отдаются по готовности
+    # вместе с номером источника, порядок внутри одного источника сохраняется
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(depth, 1))
+    slots = asyncio.Semaphore(max(concurrency, 1))
+    tasks: List[asyncio.Task] = []
+
+    async def drain(index: int, source: AsyncIterator[T]) -> None:
+        try:
+            async for item in source:
+                await queue.put((index, item))
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            slots.release()
+
+    async def feed() -> None:
+        try:
+            async for source in sources:
+                await slots.acquire()
+                tasks.append(asyncio.create_task(drain(len(tasks), source)))
+            await asyncio.gather(*tasks)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(_DONE)
+
+    feeder = asyncio.create_task(feed())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        for task in (feeder, *tasks):
+            task.cancel()
+        await asyncio.gather(feeder, *tasks, return_exceptions=True)
+
+
+async def iter_pushed(run: Callable[[Callable[[T], Awaitable[None]]], Awaitable[object]], depth: int) -> AsyncIterator[T]:
+    # источник, который сам отдаёт элементы в колбэк (COPY в asyncpg), как async-итератор:
+    # очередь ограничена, и пока потребитель не забрал элементы, колбэк источника ждёт на put
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(depth, 1))
+
+    async def produce() -> None:
+        try:
+            await run(queue.put)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(_DONE)
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
@@ -0,0 +1,132 @@
+import asyncio
+import posixpath
+import tarfile
+import zipfile
+import zlib
+from typing import AsyncIterator, Optional, Sequence, Tuple
+from fastapi import UploadFile
+from app.config import get_settings
+from app.utils.compression import iter_read_chunks, iter_upload_content, strip_encoding_suffix, upload_encoding
+from app.utils.validators import check_filename
+
+
+ARCHIVE_SUFFIXES = (('.zip', 'zip'), ('.tar.gz', 'tar'), ('.tgz', 'tar'), ('.tar', 'tar'))
+ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error)
+
+
+def upload_kind(filename: str) -> str:
+    name = filename.lower()
+    # .csv.gz и .csv.zst - сжатый csv, а не архив
+    if strip_encoding_suffix(name).endswith('.csv'):
+        return 'csv'
+    for suffix, kind in ARCHIVE_SUFFIXES:
+        if name.endswith(suffix):
+            return kind
+    raise ValueError(f'{filename}: только csv файлы (в том числе .csv.gz, .csv.zst) и архивы zip, tar, tar.gz')
+
+
+def is_service_member(name: str) -> bool:
+    # служебные файлы архиваторов (__MACOSX/, ._name.csv от macOS) пропускаются, а не считаются ошибкой
+    return name.startswith('__MACOSX/') or posixpath.basename(name).startswith('.')
+
+
+def check_member(name: str) -> None:
+    try:
+        check_filename(name)
+    except ValueError as e:
+        raise ValueError(f'{name}: {e}') from e
+
+
+async def iter_single(filename: str, chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[str, AsyncIterator[bytes]]]:
+    yield filename, chunks
+
+
+async def iter_zip_member(member: zipfile.ZipExtFile, chunk_size: int) -> AsyncIterator[bytes]:
+    try:
+        async for chunk in iter_read_chunks(member.read, chunk_size, ARCHIVE_ERRORS, 'Архив повреждён'):
+            yield chunk
+    finally:
+        member.close()
+
+
+async def iter_zip(file: UploadFile, chunk_size: int) -> AsyncIterator[Tuple[str, AsyncIterator[bytes]]]:
+    # zip читается с произвольным доступом: участники открываются независимо и распаковываются параллельно
+    try:
+        archive = await asyncio.to_thread(zipfile.ZipFile, file.file)
+    except ARCHIVE_ERRORS:
+        raise ValueError('Архив повреждён')
+    with archive:
+        for info in archive.infolist():
+            if info.is_dir() or is_service_member(info.filename):
+                continue
+            check_member(info.filename)
+            # участник открывается сразу: открытые участники держат файл и после закрытия самого архива
+            try:
+                member = await asyncio.to_thread(archive.open, info)
+            except ARCHIVE_ERRORS:
+                raise ValueError('Архив повреждён')
+            yield info.filename, iter_zip_member(member, chunk_size)
+
+
+async def iter_tar_member(member: tarfile.ExFileObject, chunk_size: int, done: asyncio.Event) -> AsyncIterator[bytes]:
+    try:
+        async for chunk in iter_read_chunks(member.read, chunk_size, ARCHIVE_ERRORS, 'Архив повреждён'):
+            yield chunk
+    finally:
+        done.set()
+
+
+async def iter_tar(file: UploadFile, chunk_size: int) -> AsyncIterator[Tuple[str, AsyncIterator[bytes]]]:
+    # tar читается потоком (сжатие gz определяется само): к следующему участнику не вернуться,
+    # поэтому следующий берётся, только когда потребитель дочитал текущий. участники tar разбираются
+    # по очереди, зато в памяти не больше чанка участника и на диск ничего не пишется
+    try:
+        archive = await asyncio.to_thread(tarfile.open, fileobj=file.file, mode='r|*')
+    except ARCHIVE_ERRORS:
+        raise ValueError('Архив повреждён')
+    with archive:
+        while True:
+            try:
+                info = await asyncio.to_thread(archive.next)
+            except ARCHIVE_ERRORS:
+                raise ValueError('Архив повреждён')
+            if info is None:
+                break
+            if not info.isfile() or is_service_member(info.name):
+                continue
+            check_member(info.name)
+            done = asyncio.Event()
+            yield info.name, iter_tar_member(archive.extractfile(info), chunk_size, done)
+            await done.wait()
+
+
+async def iter_batch_files(
+    uploads: Sequence[Tuple[UploadFile, Optional[str]]],
+    chunk_size: int,
+) -> AsyncIterator[Tuple[str, Optional[str], AsyncIterator[bytes]]]:
+    # csv и участники архивов одним потоком: (имя, хэш загруженного файла, чанки)
+    max_files = get_settings().BATCH_MAX_FILES
+    files_count = 0
+    for file, content_hash in uploads:
+        filename = file.filename or ''
+        kind = upload_kind(filename)
+        await file.seek(0)
+        members_count = 0
+        try:
+            if kind == 'csv':
+                encoding = upload_encoding(filename, file.headers.get('content-encoding'))
+                members = iter_single(filename, iter_upload_content(file, encoding, chunk_size))
+            elif kind == 'zip':
+                members = iter_zip(file, chunk_size)
+            else:
+                members = iter_tar(file, chunk_size)
+            async for name, chunks in members:
+                files_count += 1
+                if files_count > max_files:
+                    raise ValueError(f'Количество файлов превышает {max_files}')
+                members_count += 1
+                yield (name if kind == 'csv' else f'{filename}/{name}'), content_hash, chunks
+        except ValueError as e:
+            raise ValueError(f'{filename}: {e}') from e
+        if not members_count:
+            raise ValueError(f'{filename}: в архиве нет csv файлов')
@@ -0,0 +1,337 @@
+import asyncio
+import io
+import mmap
+import time
+from typing import AsyncIterator, BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+import numpy as np
+from app.config import get_settings
+from app.logger import get_logger
+from app.metrics import UPLOAD_STAGE_DURATION
+from app.schemas import MAX_NAME_LENGTH
+from app.utils.validators import MAX_REPORTED_ERRORS, REQUIRED_FIELDS, parse_date
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    # Parquet/Arrow необязательны: без пакета pyarrow принимается только csv
+    pa = None
+
+
+COLUMNAR_SUFFIXES = (('.parquet', 'parquet'), ('.pq', 'parquet'), ('.arrow', 'arrow'), ('.feather', 'arrow'))
+COLUMNAR_CONTENT_TYPES = {
+    'application/vnd.apache.parquet',
+    'application/x-parquet',
+    'application/vnd.apache.arrow.file',
+    'application/vnd.apache.arrow.stream',
+    'application/octet-stream',
+}
+# колонки ищутся по заголовкам csv или по именам полей GradeRecord
+FIELD_NAMES = {'ФИО': 'full_name', 'Номер группы': 'subject', 'Оценка': 'grade', 'Дата': 'grade_date'}
+
+logger = get_logger('ingest')
+
+
+class ArrowColumns(NamedTuple):
+    # те же поля, что у GradeColumns, но колонками arrow: ФИО и группы словарями (уникальные значения + индексы),
+    # чтобы в справочники уходили только уникальные имена, а строки шли в COPY без объектов python
+    full_name: 'pa.DictionaryArray'
+    subject: 'pa.DictionaryArray'
+    grade: 'pa.Array'
+    grade_date: 'pa.Array'
+
+
+def columnar_kind(filename: str) -> Optional[str]:
+    name = filename.lower()
+    kind = next((value for suffix, value in COLUMNAR_SUFFIXES if name.endswith(suffix)), None)
+    if kind is not None and pa is None:
+        raise ValueError('Parquet/Arrow недоступны: не установлен пакет pyarrow')
+    return kind
+
+
+def open_source(source: Union[str, BinaryIO]) -> 'pa.NativeFile':
+    # файл на диске (задача загрузки или UploadFile, в том числе ещё не сброшенный из памяти) отображается в память без копирования
+    if isinstance(source, str):
+        return pa.memory_map(source)
+    source.seek(0, io.SEEK_END)
+    size = source.tell()
+    max_size = get_settings().NAX_FILE_SIZE
+    if size > max_size:
+        raise ValueError(f'Размер файла превышает {max_size} байт')
+    if not size:
+        raise ValueError('Файл пуст')
+    try:
+        # SpooledTemporaryFile.fileno() сам откатывает содержимое из памяти на диск
+        fileno = source.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        source.seek(0)
+        return pa.BufferReader(source.read())
+    return pa.BufferReader(pa.py_buffer(mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)))
+
+
+def resolve_columns(names: List[str]) -> Dict[str, str]:
+    columns = {}
+    for header, field in FIELD_NAMES.items():
+        if header in names:
+            columns[header] = header
+        elif field in names:
+            columns[header] = field
+    if not REQUIRED_FIELDS.issubset(columns):
+        raise ValueError(f'Нет необходимых колонок. Найдены: {names}')
+    return columns
+
+
+def iter_record_batches(source: 'pa.NativeFile', kind: str, batch_size: int) -> Iterator['pa.RecordBatch']:
+    max_records = get_settings().MAX_RECORDS_PER_FILE
+    try:
+        if kind == 'parquet':
+            parquet = pq.ParquetFile(source)
+            columns = resolve_columns(parquet.schema_arrow.names)
+            # число строк есть в метаданных, лишний файл отсекается до чтения данных
+            if parquet.metadata.num_rows > max_records:
+                raise ValueError(f'Количество записей превышает {max_records}')
+            # читаются только нужные колонки, по группам строк
+            for batch in parquet.iter_batches(batch_size=batch_size, columns=list(columns.values())):
+                yield batch.rename_columns(list(columns))
+            return
+        try:
+            reader = pa.ipc.open_file(source)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+            names = reader.schema.names
+        except pa.ArrowInvalid:
+            # не файловый формат arrow - значит потоковый
+            source.seek(0)
+            reader = pa.ipc.open_stream(source)
+            batches = iter(reader)
+            names = reader.schema.names
+        columns = resolve_columns(names)
+        records_count = 0
+        for batch in batches:
+            records_count += batch.num_rows
+            if records_count > max_records:
+                raise ValueError(f'Количество записей превышает {max_records}')
+            batch = batch.select(list(columns.values())).rename_columns(list(columns))
+            # срезы record batch не копируют данные
+            for start in range(0, batch.num_rows, batch_size):
+                yield batch.slice(start, batch_size)
+    except (pa.ArrowInvalid, OSError) as e:
+        raise ValueError(f'Файл не читается как {kind}: {e}')
+
+
+def text_column(batch: 'pa.RecordBatch', name: str) -> 'pa.Array':
+    column = batch.column(name)
+    try:
+        return pc.utf8_trim_whitespace(pc.cast(column, pa.string()))
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        raise ValueError(f'Колонка {name}: тип {column.type} не поддерживается')
+
+
+def grade_column(batch: 'pa.RecordBatch') -> Tuple['pa.Array', 'pa.Array', 'pa.Array']:
+    # (оценки int16, не целое число, вне диапазона); строки с ошибками обнуляются, такой батч всё равно не уйдёт в бд
+    settings = get_settings()
+    column = batch.column('Оценка')
+    if pa.types.is_integer(column.type):
+        not_integer = pc.is_null(column)
+        values = column
+    elif pa.types.is_floating(column.type):
+        # выгрузки из pandas хранят целые оценки как float
+        not_integer = pc.fill_null(pc.not_equal(column, pc.floor(column)), True)
+        values = column
+    else:
+        # как и в csv: один ведущий '+' допустим, цифры только 0-9 (utf8_is_digit пропускает '²', на котором падает cast)
+        text = pc.replace_substring_regex(text_column(batch, 'Оценка'), r'^\+', '')
+        digits = pc.fill_null(pc.match_substring_regex(text, r'^[0-9]+$'), False)
+        not_integer = pc.invert(digits)
+        huge = pc.and_(digits, pc.greater(pc.utf8_length(text), 9))
+        values = pc.cast(pc.if_else(pc.and_(digits, pc.invert(huge)), text, '0'), pa.int64())
+    out_of_range = pc.fill_null(pc.or_(pc.less(values, settings.MIN_GRADE), pc.greater(values, settings.MAX_GRADE)), False)
+    out_of_range = pc.and_(out_of_range, pc.invert(not_integer))
+    bad = pc.or_(not_integer, out_of_range)
+    grade = pc.cast(pc.if_else(bad, 0, pc.fill_null(values, 0)), pa.int16(), safe=False)
+    return grade, not_integer, out_of_range
+
+
+def date_column(batch: 'pa.RecordBatch') -> 'pa.Array':
+    column = batch.column('Дата')
+    if pa.types.is_date(column.type) or pa.types.is_timestamp(column.type):
+        return pc.cast(column, pa.date32())
+    # различных дат единицы: строки разбираются тем же parse_date, что и в csv, по разу на значение
+    encoded = pc.dictionary_encode(text_column(batch, 'Дата'))
+    parsed = pa.array([parse_date(text) for text in encoded.dictionary.to_pylist()], pa.date32())
+    return pc.take(parsed, encoded.indices)
+
+
+def parse_record_batch(batch: 'pa.RecordBatch', first_row_num: int) -> Tuple[Optional[ArrowColumns], List[str], int, float, float]:
+    # те же ограничения GradeRecord, что у parse_columns для csv, только векторно по колонкам arrow
+    started = time.perf_counter()
+    full_name = text_column(batch, 'ФИО')
+    subject = text_column(batch, 'Номер группы')
+    grade, not_integer, out_of_range = grade_column(batch)
+    grade_date = date_column(batch)
+    parsed = time.perf_counter()
+    name_lengths = pc.utf8_length(full_name)
+    subject_lengths = pc.utf8_length(subject)
+    checks = [
+        (pc.or_(pc.equal(name_lengths, 0), pc.greater(name_lengths, MAX_NAME_LENGTH)), f'ФИО должно быть от 1 до {MAX_NAME_LENGTH} символов'),
+        (pc.or_(pc.equal(subject_lengths, 0), pc.greater(subject_lengths, MAX_NAME_LENGTH)), f'Номер группы должен быть от 1 до {MAX_NAME_LENGTH} символов'),
+        (pc.is_null(grade_date), 'дата должна быть в формате ДД.ММ.ГГГГ'),
+        (not_integer, 'оценка должна быть целым числом'),
+        (out_of_range, f'оценка должна быть от {get_settings().MIN_GRADE} до {get_settings().MAX_GRADE}'),
+    ]
+    masks = [(pc.fill_null(mask, True).to_numpy(zero_copy_only=False), message) for mask, message in checks]
+    bad = np.logical_or.reduce([mask for mask, _ in masks])
+    errors_count = int(bad.sum())
+    if not errors_count:
+        columns = ArrowColumns(pc.dictionary_encode(full_name), pc.dictionary_encode(subject), grade, grade_date)
+        return columns, [], 0, parsed - started, time.perf_counter() - parsed
+    errors = []
+    for index in np.flatnonzero(bad)[:MAX_REPORTED_ERRORS]:
+        reasons = ', '.join(message for mask, message in masks if mask[index])
+        errors.append(f'Строка {first_row_num + index}: {reasons}')
+    return None, errors, errors_count, parsed - started, time.perf_counter() - parsed
+
+
+async def iter_columnar_batches(source: Union[str, BinaryIO], kind: str, batch_size: int) -> AsyncIterator[ArrowColumns]:
+    # чтение и проверки в потоке: pyarrow отпускает GIL, event loop не блокируется
+    started = time.perf_counter()
+    reader = open_source(source)
+    batches = iter_record_batches(reader, kind, batch_size)
+    row_num = 1
+    records_count = 0
+    errors: List[str] = []
+    errors_count = 0
+
+    def next_batch(first_row_num: int):
+        with UPLOAD_STAGE_DURATION.time('read'):
+            batch = next(batches, None)
+        return None if batch is None else (batch.num_rows, parse_record_batch(batch, first_row_num))
+
+    try:
+        while True:
+            result = await asyncio.to_thread(next_batch, row_num)
+            if result is None:
+                break
+            rows, (columns, block_errors, block_errors_count, parse_seconds, validate_seconds) = result
+            UPLOAD_STAGE_DURATION.observe(parse_seconds, 'parse')
+            UPLOAD_STAGE_DURATION.observe(validate_seconds, 'validate')
+            row_num += rows
+            records_count += rows
+            errors_count += block_errors_count
+            errors.extend(block_errors[:MAX_REPORTED_ERRORS - len(errors)])
+            # после первой ошибки загрузка всё равно откатится, дальше только считаем ошибки
+            if not errors_count and rows:
+                yield columns
+        fields = {
+            'format': kind,
+            'records': records_count,
+            'invalid_rows': errors_count,
+            'duration_seconds': round(time.perf_counter() - started, 4),
+        }
+        if errors_count:
+            logger.warning('Файл не прошёл проверку', extra={'fields': {**fields, 'sample_errors': errors}})
+            raise ValueError(f"На стадии парсинга ошибки ({errors_count}): {';'.join(errors)}")
+        logger.info('Файл разобран', extra={'fields': fields})
+    finally:
+        # если загрузку отменили посреди чтения, поток ещё внутри генератора: его закроет сборщик мусора
+        try:
+            batches.close()
+        except ValueError:
+            pass
+        reader.close()
+
+
+def encode_staging(columns: ArrowColumns, student_ids: List[int], group_ids: List[int]) -> Tuple[bytes, int]:
+    # id из справочников раскладываются по строкам индексами словаря, батч уходит в COPY готовым csv
+    table = pa.table({
+        'student_id': pc.take(pa.array(student_ids, pa.int32()), columns.full_name.indices),
+        'group_id': pc.take(pa.array(group_ids, pa.int32()), columns.subject.indices),
+        'grade': columns.grade,
+        'grade_date': columns.grade_date,
+    })
+    sink = pa.BufferOutputStream()
+    pa_csv.write_csv(table, sink, pa_csv.WriteOptions(include_header=False))
+    return sink.getvalue().to_pybytes(), table.num_rows
+
+
+def check_parquet() -> None:
+    if pa is None:
+        raise ValueError('Parquet недоступен: не установлен пакет pyarrow')
+
+
+def rows_end(data: bytes) -> int:
+    # конец последней целой строки csv: перевод строки внутри значения в кавычках границей не считается
+    end = data.rfind(b'\n')
+    while end >= 0 and data.count(b'"', 0, end) % 2:
+        end = data.rfind(b'\n', 0, end)
+    return end + 1
+
+
+class ChunkSink:
+    # файл для ParquetWriter, из которого записанное забирается кусками после каждой группы строк
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.size = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.size
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+async def iter_parquet(chunks: AsyncIterator[bytes], columns: Sequence[Tuple[str, str]], block_size: int) -> AsyncIterator[bytes]:
+    # csv без заголовка (COPY ... TO STDOUT) перекладывается в parquet блоками по целым строкам: блок разбирается
+    # arrow и пишется отдельной группой строк, в памяти не больше блока и его группы; columns - (имя, тип arrow)
+    schema = pa.schema([(name, pa.type_for_alias(type_name)) for name, type_name in columns])
+    read_options = pa_csv.ReadOptions(column_names=schema.names)
+    parse_options = pa_csv.ParseOptions(delimiter=';', newlines_in_values=True)
+    convert_options = pa_csv.ConvertOptions(column_types=schema)
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+
+    def write(block: memoryview) -> bytes:
+        writer.write_table(pa_csv.read_csv(pa.py_buffer(block), read_options, parse_options, convert_options))
+        return sink.take()
+
+    def close() -> bytes:
+        writer.close()
+        return sink.take()
+
+    pending: List[bytes] = []
+    pending_size = 0
+    try:
+        async for chunk in chunks:
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size < block_size:
+                continue
+            data = b''.join(pending)
+            end = rows_end(data)
+            pending = [data[end:]]
+            pending_size = len(pending[0])
+            if end:
+                # разбор и сжатие в потоке: arrow отпускает GIL, COPY тем временем наполняет очередь
+                yield await asyncio.to_thread(write, memoryview(data)[:end])
+        if pending_size:
+            yield await asyncio.to_thread(write, memoryview(b''.join(pending)))
+        yield await asyncio.to_thread(close)
+    finally:
+        # повторный close у ParquetWriter ничего не делает; источник закрывается сам, чтобы COPY не ждал в очереди
+        writer.close()
+        await chunks.aclose()
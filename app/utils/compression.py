@@ -0,0 +1,92 @@
+import asyncio
+import gzip
+import zlib
+from typing import AsyncIterator, BinaryIO, Callable, Optional, Tuple, Type
+from fastapi import UploadFile
+from app.config import get_settings
+from app.metrics import UPLOAD_STAGE_DURATION
+from app.utils.validators import iter_upload_chunks
+
+try:
+    import zstandard
+except ImportError:
+    # zstd необязателен: без пакета zstandard такие загрузки отклоняются, gzip работает всегда
+    zstandard = None
+
+
+CONTENT_ENCODINGS = {'gzip': 'gzip', 'x-gzip': 'gzip', 'zstd': 'zstd'}
+ENCODING_SUFFIXES = (('.gz', 'gzip'), ('.zst', 'zstd'))
+# у сжатого файла клиенты ставят тип сжатия, а не text/csv
+COMPRESSED_CONTENT_TYPES = {'application/gzip', 'application/x-gzip', 'application/zstd', 'application/octet-stream'}
+DECODE_ERRORS: Tuple[Type[Exception], ...] = (gzip.BadGzipFile, EOFError, zlib.error) + (
+    (zstandard.ZstdError,) if zstandard is not None else ()
+)
+
+
+def upload_encoding(filename: str, content_encoding: Optional[str] = None) -> Optional[str]:
+    # Content-Encoding части формы важнее расширения имени (.csv.gz, .csv.zst)
+    if content_encoding:
+        name = content_encoding.strip().lower()
+        if name == 'identity':
+            return None
+        encoding = CONTENT_ENCODINGS.get(name)
+        if encoding is None:
+            raise ValueError(f'Неподдерживаемое сжатие: {content_encoding}')
+    else:
+        encoding = next((value for suffix, value in ENCODING_SUFFIXES if filename.lower().endswith(suffix)), None)
+    if encoding == 'zstd' and zstandard is None:
+        raise ValueError('Сжатие zstd недоступно: не установлен пакет zstandard')
+    return encoding
+
+
+def strip_encoding_suffix(filename: str) -> str:
+    for suffix, _ in ENCODING_SUFFIXES:
+        if filename.lower().endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+async def iter_read_chunks(
+    read: Callable[[int], bytes],
+    chunk_size: int,
+    errors: Tuple[Type[Exception], ...],
+    message: str,
+) -> AsyncIterator[bytes]:
+    # распаковка блокирующая, поэтому в потоке; лимит NAX_FILE_SIZE на распакованный размер, а не на сжатый
+    max_size = get_settings().NAX_FILE_SIZE
+    total_size = 0
+    while True:
+        try:
+            with UPLOAD_STAGE_DURATION.time('read'):
+                chunk = await asyncio.to_thread(read, chunk_size)
+        except errors:
+            raise ValueError(message)
+        if not chunk:
+            break
+        total_size += len(chunk)
+        if total_size > max_size:
+            raise ValueError(f'Размер файла превышает {max_size} байт')
+        yield chunk
+
+
+def open_decoded(fileobj: BinaryIO, encoding: str) -> BinaryIO:
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True, closefd=False)
+
+
+async def iter_decoded_chunks(fileobj: BinaryIO, encoding: str, chunk_size: int) -> AsyncIterator[bytes]:
+    # распакованный файл целиком не собирается: за одно чтение распаковывается не больше chunk_size байт,
+    # и бомба из пары килобайт останавливается на первом же превышении NAX_FILE_SIZE
+    decoded = open_decoded(fileobj, encoding)
+    try:
+        async for chunk in iter_read_chunks(decoded.read, chunk_size, DECODE_ERRORS, 'Сжатый файл повреждён'):
+            yield chunk
+    finally:
+        decoded.close()
+
+
+def iter_upload_content(file: UploadFile, encoding: Optional[str], chunk_size: int) -> AsyncIterator[bytes]:
+    if encoding is None:
+        return iter_upload_chunks(file, chunk_size)
+    return iter_decoded_chunks(file.file, encoding, chunk_size)
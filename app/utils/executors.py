@@ -0,0 +1,51 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+from app.config import get_settings
+
+
+_parse_executor: Optional[Executor] = None
+
+
+def get_parse_workers() -> int:
+    settings = get_settings()
+    if settings.PARSE_EXECUTOR == 'inline':
+        return 1
+    return settings.PARSE_WORKERS or multiprocessing.cpu_count()
+
+
+def get_parse_executor() -> Optional[Executor]:
+    global _parse_executor
+    settings = get_settings()
+    if settings.PARSE_EXECUTOR == 'inline':
+        return None
+    if _parse_executor is None:
+        if settings.PARSE_EXECUTOR == 'process':
+            # spawn: fork процесса с работающим event loop и пулом соединений небезопасен
+            _parse_executor = ProcessPoolExecutor(
+                max_workers = get_parse_workers(),
+                mp_context = multiprocessing.get_context('spawn'),
+            )
+        else:
+            _parse_executor = ThreadPoolExecutor(
+                max_workers = get_parse_workers(),
+                thread_name_prefix = 'csv-parse',
+            )
+    return _parse_executor
+
+
+async def warm_up_parse_executor() -> None:
+    # процессы пула стартуют лениво, без прогрева первая загрузка ждёт импорт приложения в каждом из них
+    executor = get_parse_executor()
+    if executor is None:
+        return
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(executor, abs, 0) for _ in range(get_parse_workers())))
+
+
+def shutdown_parse_executor() -> None:
+    global _parse_executor
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=False, cancel_futures=True)
+        _parse_executor = None
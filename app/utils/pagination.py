@@ -0,0 +1,29 @@
+import base64
+import json
+import orjson
+from typing import AsyncIterator, Tuple
+
+INT4_MAX = 2 ** 31 - 1
+
+
+def encode_cursor(count: int, full_name: str) -> str:
+    # курсор - последняя отданная пара (count, full_name), клиенту он непрозрачен
+    raw = json.dumps([count, full_name], ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        count, full_name = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError('Некорректный курсор')
+    # count уходит в запрос как int4: bool и числа вне диапазона отсекаем здесь, а не ошибкой базы
+    if type(count) is not int or not 0 <= count <= INT4_MAX or not isinstance(full_name, str):
+        raise ValueError('Некорректный курсор')
+    return count, full_name
+
+
+async def iter_ndjson(rows: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    async for row in rows:
+        yield orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE)
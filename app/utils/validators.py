@@ -1,38 +1,290 @@
-﻿import csv
-import io
-from app.schemas import GradeRecord
+﻿import asyncio
+import codecs
+import csv
+import time
+from collections import deque
+from datetime import date, datetime
+import numpy as np
+from typing import AsyncIterator, Deque, Dict, List, NamedTuple, Optional, Sequence, Tuple
+from fastapi import UploadFile
+from app.config import get_settings
+from app.logger import get_logger
+from app.metrics import UPLOAD_STAGE_DURATION
+from app.schemas import MAX_NAME_LENGTH
+from app.utils.executors import get_parse_executor, get_parse_workers
 
 
-async def validate_csv_file(file_content: bytes, filename: str):
+REQUIRED_FIELDS = {'Дата', 'Номер группы', 'ФИО', 'Оценка'}
+MAX_REPORTED_ERRORS = 5
+DATE_FORMATS = ('%d.%m.%Y', '%Y-%m-%d')
+
+logger = get_logger('ingest')
+
+
+
+class GradeColumns(NamedTuple):
+    full_name: List[str]
+    subject: List[str]
+    grade: List[int]
+    grade_date: List[Optional[date]]
+
+
+EMPTY_COLUMNS = GradeColumns([], [], [], [])
+
+
+def check_filename(filename: str) -> None:
     if not filename.lower().endswith('.csv'):
         raise ValueError('Только csv файлы')
 
-    records = []
-    errors = []
 
+async def iter_upload_chunks(file: UploadFile, chunk_size: int) -> AsyncIterator[bytes]:
+    max_size = get_settings().NAX_FILE_SIZE
+    total_size = 0
+    while True:
+        with UPLOAD_STAGE_DURATION.time('read'):
+            chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        total_size += len(chunk)
+        if total_size > max_size:
+            raise ValueError(f'Размер файла превышает {max_size} байт')
+        yield chunk
+
+
+def ends_in_quotes(line: str, in_quotes: bool) -> bool:
+    # кавычки как у csv.reader: поле в кавычках открывает только кавычка в начале поля, "" внутри - сама кавычка,
+    # кавычка посреди поля без кавычек (O"Brien) - обычный символ и запись не продолжает
+    pos = 0
+    while True:
+        if in_quotes:
+            end = line.find('"', pos)
+            if end < 0:
+                return True
+            if line.startswith('"', end + 1):
+                pos = end + 2
+                continue
+            in_quotes = False
+            pos = end + 1
+        elif line.startswith('"', pos):
+            in_quotes = True
+            pos += 1
+            continue
+        # до конца поля кавычки ничего не значат
+        pos = line.find(';', pos)
+        if pos < 0:
+            return False
+        pos += 1
+
+
+async def iter_csv_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    # utf-8-sig сам срезает BOM, даже если он разрезан между чанками
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    tail = ''
+    pending = ''
+    in_quotes = False
     try:
-        content_str = file_content.decode('utf-8')
-        if content_str.startswith('\ufeff'):
-            content_str = content_str[1:]
-        print(f"DEBUG: First line: {content_str.split(chr(10))[0]}")
-        csv_reader = csv.DictReader(io.StringIO(content_str), delimiter=';')
-        print(f"DEBUG: Fieldnames: {csv_reader.fieldnames}")
-        required_fields = {'Дата', 'Номер группы', 'ФИО', 'Оценка'}
-        if not required_fields.issubset(set(csv_reader.fieldnames or [])):
-            raise ValueError(f'Нет необходимых колонок. Найдены: {csv_reader.fieldnames}')
-        
-        for row_num, row in enumerate(csv_reader, start=2):
-            try:
-                print(f"DEBUG: Row {row_num}: {row}")
-                record = GradeRecord(
-                    full_name=row['ФИО'].strip(),
-                    subject=row['Номер группы'].strip(),
-                    grade=int(row['Оценка'])
-                )
-                records.append(record)
-            except ValueError as e:
-                errors.append(f'Строка {row_num}: {str(e)}')
+        async for chunk in chunks:
+            with UPLOAD_STAGE_DURATION.time('decode'):
+                lines = (tail + decoder.decode(chunk)).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                # строка в кавычках может содержать перенос, отдаём только целые записи
+                pending += line + '\n'
+                if in_quotes or '"' in line:
+                    in_quotes = ends_in_quotes(line, in_quotes)
+                if not in_quotes:
+                    yield pending
+                    pending = ''
+        tail += decoder.decode(b'', final=True)
     except UnicodeDecodeError:
         raise ValueError('Файл должен быть в UTF-8')
-    
-    return records, errors
+    if pending or tail:
+        yield pending + tail
+
+
+def parse_header(line: str) -> Dict[str, int]:
+    fieldnames = next(csv.reader([line], delimiter=';'), [])
+    logger.debug('Колонки CSV: %s', fieldnames)
+    if not REQUIRED_FIELDS.issubset(set(fieldnames)):
+        raise ValueError(f'Нет необходимых колонок. Найдены: {fieldnames}')
+    return {name: fieldnames.index(name) for name in REQUIRED_FIELDS}
+
+
+def parse_date(text: str) -> Optional[date]:
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def ascii_digits(text: np.ndarray) -> np.ndarray:
+    # только 0-9: np.char.isdigit пропускает '²' и прочие цифры юникода, на которых падает astype(int)
+    lengths = np.char.str_len(text)
+    if not text.dtype.itemsize:
+        return np.zeros(len(text), dtype=bool)
+    codes = text.view(np.uint32).reshape(len(text), -1)
+    # хвост после конца строки в массиве 'U' заполнен нулями
+    inside = np.arange(codes.shape[1]) < lengths[:, None]
+    return (lengths > 0) & np.where(inside, (codes >= ord('0')) & (codes <= ord('9')), True).all(axis=1)
+
+
+def clip_column(values: Tuple[str, ...]) -> Sequence[str]:
+    # массив 'U' шириной в самое длинное поле блока: одно поле в 100 000 символов раздуло бы блок до гигабайтов.
+    # поле длиннее MAX_NAME_LENGTH и после strip заменяется пустым, строка получает обычную ошибку проверки
+    lengths = np.fromiter(map(len, values), dtype=np.int64, count=len(values))
+    long = np.flatnonzero(lengths > MAX_NAME_LENGTH)
+    if not len(long):
+        return values
+    values = list(values)
+    for index in long:
+        value = values[index].strip()
+        values[index] = value if len(value) <= MAX_NAME_LENGTH else ''
+    return values
+
+
+def parse_columns(lines: List[str], columns: Dict[str, int], first_row_num: int) -> Tuple[GradeColumns, List[str], int, float, float]:
+    # выполняется в пуле процессов: на вход только непустые строки, по одной записи на строку,
+    # поэтому номер строки считается без оглядки на соседние блоки.
+    # метрики процесса-воркера до приложения не доходят, поэтому время стадий возвращается вместе с результатом
+    started = time.perf_counter()
+    settings = get_settings()
+    rows = []
+    try:
+        for row in csv.reader(lines, delimiter=';'):
+            rows.append(row)
+    except csv.Error as e:
+        # одна запись на элемент lines, поэтому номер строки - по числу уже разобранных
+        raise ValueError(f'Строка {first_row_num + len(rows)}: некорректная строка csv ({e})')
+    width = max(columns.values()) + 1
+    row_nums = np.arange(first_row_num, first_row_num + len(rows))
+    short = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows)) < width
+    if short.any():
+        rows = [row for row in rows if len(row) >= width]
+    checks = [(short, 'не хватает колонок')]
+    table = list(zip(*rows)) if rows else [()] * width
+    full_name = np.char.strip(np.array(clip_column(table[columns['ФИО']]), dtype=str))
+    subject = np.char.strip(np.array(clip_column(table[columns['Номер группы']]), dtype=str))
+    grade_text = np.char.strip(np.array(clip_column(table[columns['Оценка']]), dtype=str))
+    date_text = np.char.strip(np.array(clip_column(table[columns['Дата']]), dtype=str))
+    parsed = time.perf_counter()
+    # различных дат в файле единицы, strptime вызывается по одному разу на значение
+    unique_dates, date_index = np.unique(date_text, return_inverse=True)
+    unique_parsed = np.empty(len(unique_dates), dtype=object)
+    unique_parsed[:] = [parse_date(text) for text in unique_dates]
+    grade_date = unique_parsed[date_index]
+    bad_date = np.array([value is None for value in unique_parsed], dtype=bool)[date_index]
+    # проверки на весь блок разом, без построения модели на каждую строку
+    name_lengths = np.char.str_len(full_name)
+    subject_lengths = np.char.str_len(subject)
+    # как int(): один плюс впереди допустим
+    grade_text = np.where(np.char.startswith(grade_text, '+'), np.char.replace(grade_text, '+', '', 1), grade_text)
+    digits = ascii_digits(grade_text)
+    huge = digits & (np.char.str_len(grade_text) > 9)
+    grade = np.where(digits & ~huge, grade_text, '0').astype(np.int64)
+    for mask, message in (
+        ((name_lengths == 0) | (name_lengths > MAX_NAME_LENGTH), f'ФИО должно быть от 1 до {MAX_NAME_LENGTH} символов'),
+        ((subject_lengths == 0) | (subject_lengths > MAX_NAME_LENGTH), f'Номер группы должен быть от 1 до {MAX_NAME_LENGTH} символов'),
+        (bad_date, 'дата должна быть в формате ДД.ММ.ГГГГ'),
+        (~digits, 'оценка должна быть целым числом'),
+        (huge | (digits & ((grade < settings.MIN_GRADE) | (grade > settings.MAX_GRADE))), f'оценка должна быть от {settings.MIN_GRADE} до {settings.MAX_GRADE}'),
+    ):
+        full_mask = np.zeros(len(row_nums), dtype=bool)
+        full_mask[~short] = mask
+        checks.append((full_mask, message))
+    bad = np.logical_or.reduce([mask for mask, _ in checks])
+    errors_count = int(bad.sum())
+    if not errors_count:
+        batch = GradeColumns(full_name.tolist(), subject.tolist(), grade.tolist(), grade_date.tolist())
+        return batch, [], 0, parsed - started, time.perf_counter() - parsed
+    errors = []
+    for index in np.flatnonzero(bad)[:MAX_REPORTED_ERRORS]:
+        reasons = ', '.join(message for mask, message in checks if mask[index])
+        errors.append(f'Строка {row_nums[index]}: {reasons}')
+    return EMPTY_COLUMNS, errors, errors_count, parsed - started, time.perf_counter() - parsed
+
+
+async def iter_grade_batches(chunks: AsyncIterator[bytes], batch_size: int) -> AsyncIterator[GradeColumns]:
+    max_records = get_settings().MAX_RECORDS_PER_FILE
+    loop = asyncio.get_running_loop()
+    executor = get_parse_executor()
+    max_in_flight = get_parse_workers() + 1
+    in_flight: Deque[asyncio.Future] = deque()
+    columns = None
+    block: List[str] = []
+    row_num = 2
+    records_count = 0
+    errors: List[str] = []
+    errors_count = 0
+    blocks_count = 0
+    started = time.perf_counter()
+
+    def submit() -> None:
+        nonlocal row_num, blocks_count
+        lines = block.copy()
+        block.clear()
+        if executor is None:
+            future = loop.create_future()
+            future.set_result(parse_columns(lines, columns, row_num))
+        else:
+            future = loop.run_in_executor(executor, parse_columns, lines, columns, row_num)
+        in_flight.append(future)
+        row_num += len(lines)
+        blocks_count += 1
+
+    async def collect() -> GradeColumns:
+        nonlocal errors_count
+        batch, block_errors, block_errors_count, parse_seconds, validate_seconds = await in_flight.popleft()
+        UPLOAD_STAGE_DURATION.observe(parse_seconds, 'parse')
+        UPLOAD_STAGE_DURATION.observe(validate_seconds, 'validate')
+        # сводка по блоку вместо построчного вывода; аргументы форматируются только на уровне DEBUG
+        logger.debug(
+            'Блок разобран: строк %d, ошибок %d, парсинг %.4f с, проверка %.4f с',
+            len(batch.grade), block_errors_count, parse_seconds, validate_seconds,
+        )
+        errors_count += block_errors_count
+        errors.extend(block_errors[:MAX_REPORTED_ERRORS - len(errors)])
+        # после первой ошибки загрузка всё равно откатится, дальше только считаем ошибки
+        return batch if not errors_count else EMPTY_COLUMNS
+
+    try:
+        async for line in iter_csv_lines(chunks):
+            if columns is None:
+                columns = parse_header(line)
+                continue
+            if not line.strip('\r\n'):
+                continue
+            records_count += 1
+            if records_count > max_records:
+                raise ValueError(f'Количество записей превышает {max_records}')
+            block.append(line)
+            if len(block) >= batch_size:
+                submit()
+                # блоки парсятся параллельно, а отдаются строго по порядку
+                if len(in_flight) >= max_in_flight:
+                    batch = await collect()
+                    if batch.grade:
+                        yield batch
+        if columns is None:
+            raise ValueError('Нет необходимых колонок. Найдены: []')
+        if block:
+            submit()
+        while in_flight:
+            batch = await collect()
+            if batch.grade:
+                yield batch
+        fields = {
+            'records': records_count,
+            'blocks': blocks_count,
+            'invalid_rows': errors_count,
+            'duration_seconds': round(time.perf_counter() - started, 4),
+        }
+        if errors_count:
+            # в лог попадают только первые MAX_REPORTED_ERRORS строк с ошибками, остальные лишь считаются
+            logger.warning('CSV не прошёл проверку', extra={'fields': {**fields, 'sample_errors': errors}})
+            raise ValueError(f"На стадии парсинга ошибки ({errors_count}): {';'.join(errors)}")
+        logger.info('CSV разобран', extra={'fields': fields})
+    finally:
+        for future in in_flight:
+            future.cancel()
@@ -0,0 +1,69 @@
+# python -m benchmarks.bench_bulk_insert --sizes 1000 10000 1000000
+import argparse
+import asyncio
+import random
+import time
+import asyncpg
+from app.config import get_settings
+from app.services.bulk_loader import BulkLoader, GRADE_COLUMNS
+
+
+BENCH_TABLE = 'bench_grades'
+
+
+def make_rows(size: int):
+    rnd = random.Random(size)
+    # без даты строки не попадают под уникальный естественный ключ; студенты и группы - id из справочников
+    return [(rnd.randrange(size // 10 + 1), rnd.randrange(50), rnd.randint(1, 5), None) for _ in range(size)]
+
+
+async def run_executemany(conn: asyncpg.Connection, rows) -> None:
+    await conn.executemany(f'INSERT INTO {BENCH_TABLE} ({", ".join(GRADE_COLUMNS)}) VALUES ($1, $2, $3, $4)', rows)
+
+
+async def run_copy(conn: asyncpg.Connection, rows) -> None:
+    loader = BulkLoader(conn, table=BENCH_TABLE, min_copy_rows=0)
+    await loader.add(list(zip(*rows)))
+    await loader.flush()
+
+
+async def measure(conn: asyncpg.Connection, method, rows) -> float:
+    await conn.execute(f'TRUNCATE {BENCH_TABLE}')
+    started = time.perf_counter()
+    async with conn.transaction():
+        await method(conn, rows)
+    return len(rows) / (time.perf_counter() - started)
+
+
+async def main(sizes, skip_executemany_above: int) -> None:
+    settings = get_settings()
+    conn = await asyncpg.connect(
+        host = settings.DB_HOST,
+        port = settings.DB_PORT,
+        user = settings.DB_USER,
+        password = settings.DB_PASSWORD,
+        database = settings.DB_NAME,
+    )
+    try:
+        await conn.execute(f'DROP TABLE IF EXISTS {BENCH_TABLE}')
+        await conn.execute(f'CREATE TABLE {BENCH_TABLE} (LIKE grades INCLUDING ALL)')
+        print(f'{"rows":>10} {"executemany rows/s":>20} {"copy rows/s":>15} {"speedup":>8}')
+        for size in sizes:
+            rows = make_rows(size)
+            copy_rate = await measure(conn, run_copy, rows)
+            if size > skip_executemany_above:
+                print(f'{size:>10} {"skipped":>20} {copy_rate:>15.0f} {"-":>8}')
+                continue
+            many_rate = await measure(conn, run_executemany, rows)
+            print(f'{size:>10} {many_rate:>20.0f} {copy_rate:>15.0f} {copy_rate / many_rate:>7.1f}x')
+    finally:
+        await conn.execute(f'DROP TABLE IF EXISTS {BENCH_TABLE}')
+        await conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='executemany vs COPY для таблицы grades')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 1000000])
+    parser.add_argument('--skip-executemany-above', type=int, default=10 ** 7)
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes, args.skip_executemany_above))
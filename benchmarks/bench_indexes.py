@@ -0,0 +1,144 @@
+# python -m benchmarks.bench_indexes --rows 1000000
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from datetime import date, timedelta
+import asyncpg
+from app.config import get_settings
+from app.services.bulk_loader import BulkLoader
+from app.services.grade_service import build_grade_counts_query
+
+
+BENCH_TABLE = 'bench_grades'
+BENCH_STUDENTS = 'bench_students'
+BENCH_GROUPS = 'bench_groups'
+GROUPS = 50
+TERM_FROM = date(2025, 9, 1)
+TERM_TO = date(2026, 1, 31)
+
+# до: индексы первой миграции и запрос по двойкам через все счётчики; после: набор из миграции d1a6f3c8b5e2
+INDEX_SETS = {
+    'before': (False, (
+        'CREATE INDEX ON {table} (student_id)',
+        'CREATE INDEX ON {table} (grade)',
+        'CREATE INDEX ON {table} (group_id)',
+        'CREATE INDEX ON {table} (student_id, grade)',
+        'CREATE INDEX ON {table} (grade_date)',
+        'CREATE UNIQUE INDEX ON {table} (grade_date, group_id, student_id)',
+    )),
+    'after': (True, (
+        'CREATE UNIQUE INDEX ON {table} (grade_date, group_id, student_id)',
+        'CREATE INDEX ON {table} (group_id, grade_date) INCLUDE (student_id, grade)',
+        'CREATE INDEX ON {table} (student_id) INCLUDE (grade_date, group_id) WHERE grade = 2',
+    )),
+}
+
+
+def make_rows(size: int):
+    rnd = random.Random(size)
+    days = (TERM_TO - TERM_FROM).days + 1
+    students = size // 20 + 1
+    # строки уникальны по (дата, группа, студент), как после слияния по естественному ключу
+    keys = set()
+    while len(keys) < size:
+        keys.add((TERM_FROM + timedelta(days=rnd.randrange(days)), rnd.randrange(1, GROUPS + 1), rnd.randrange(1, students + 1)))
+    return students, [(student_id, group_id, rnd.randint(2, 5), day) for day, group_id, student_id in keys]
+
+
+def bench_query(query: str) -> str:
+    return (
+        query
+        .replace('FROM grades', f'FROM {BENCH_TABLE}')
+        .replace('JOIN students ', f'JOIN {BENCH_STUDENTS} ')
+        .replace('FROM groups ', f'FROM {BENCH_GROUPS} ')
+    )
+
+
+def make_queries(single: bool):
+    twos, twos_args = build_grade_counts_query(2, None, TERM_FROM, TERM_TO, single=single)
+    group, group_args = build_grade_counts_query(2, 'Группа 7', TERM_FROM, TERM_TO)
+    return {
+        'more-than-3-twos': (bench_query(twos), (4, None, None, *twos_args)),
+        'less-than-5-twos': (bench_query(twos), (1, 4, None, *twos_args)),
+        'grade-counts group': (bench_query(group), (None, None, None, *group_args)),
+    }
+
+
+async def load(conn: asyncpg.Connection, indexes, rows) -> float:
+    await conn.execute(f'DROP TABLE IF EXISTS {BENCH_TABLE}')
+    await conn.execute(f'CREATE TABLE {BENCH_TABLE} (LIKE grades INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+    for index in indexes:
+        await conn.execute(index.format(table=BENCH_TABLE))
+    started = time.perf_counter()
+    async with conn.transaction():
+        loader = BulkLoader(conn, table=BENCH_TABLE, min_copy_rows=0)
+        await loader.add(list(zip(*rows)))
+        await loader.flush()
+    rate = len(rows) / (time.perf_counter() - started)
+    # index-only scan опирается на карту видимости, её заполняет VACUUM
+    await conn.execute(f'VACUUM ANALYZE {BENCH_TABLE}')
+    return rate
+
+
+async def latency(conn: asyncpg.Connection, query: str, args, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await conn.fetch(query, *args)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+async def main(size: int, repeat: int) -> None:
+    settings = get_settings()
+    conn = await asyncpg.connect(
+        host = settings.DB_HOST,
+        port = settings.DB_PORT,
+        user = settings.DB_USER,
+        password = settings.DB_PASSWORD,
+        database = settings.DB_NAME,
+    )
+    try:
+        students, rows = make_rows(size)
+        await conn.execute(f'DROP TABLE IF EXISTS {BENCH_STUDENTS}, {BENCH_GROUPS}')
+        await conn.execute(f'CREATE TABLE {BENCH_STUDENTS} (LIKE students INCLUDING ALL)')
+        await conn.execute(f'CREATE TABLE {BENCH_GROUPS} (LIKE groups INCLUDING ALL)')
+        await conn.copy_records_to_table(
+            BENCH_STUDENTS, records=[(i, f'Студент {i}') for i in range(1, students + 1)], columns=['id', 'full_name']
+        )
+        await conn.copy_records_to_table(
+            BENCH_GROUPS, records=[(i, f'Группа {i}') for i in range(1, GROUPS + 1)], columns=['id', 'name']
+        )
+        await conn.execute(f'ANALYZE {BENCH_STUDENTS}, {BENCH_GROUPS}')
+
+        results = {}
+        for name, (single, indexes) in INDEX_SETS.items():
+            rate = await load(conn, indexes, rows)
+            index_size = await conn.fetchval(f"SELECT pg_indexes_size('{BENCH_TABLE}')")
+            timings = {
+                query_name: await latency(conn, query, args, repeat)
+                for query_name, (query, args) in make_queries(single).items()
+            }
+            results[name] = (rate, index_size, timings)
+
+        before, after = results['before'], results['after']
+        print(f'{size} rows, median of {repeat} runs')
+        print(f'{"":>22} {"before":>12} {"after":>12} {"gain":>7}')
+        print(f'{"insert rows/s":>22} {before[0]:>12.0f} {after[0]:>12.0f} {after[0] / before[0]:>6.1f}x')
+        print(f'{"index size MB":>22} {before[1] / 2 ** 20:>12.1f} {after[1] / 2 ** 20:>12.1f} {before[1] / after[1]:>6.1f}x')
+        for query_name in before[2]:
+            old, new = before[2][query_name], after[2][query_name]
+            print(f'{query_name + " ms":>22} {old:>12.2f} {new:>12.2f} {old / new:>6.1f}x')
+    finally:
+        await conn.execute(f'DROP TABLE IF EXISTS {BENCH_TABLE}, {BENCH_STUDENTS}, {BENCH_GROUPS}')
+        await conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='вставка и запросы по grades: старый набор индексов против нового')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.repeat))
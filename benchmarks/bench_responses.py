@@ -0,0 +1,102 @@
+# python -m benchmarks.bench_responses --sizes 1000 10000
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import List
+import asyncpg
+import orjson
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from app.config import get_settings
+from app.schemas import StudentGradeCounts
+from app.services.grade_service import build_grade_counts_query
+
+
+BENCH_TABLE = 'bench_student_grade_stats'
+BENCH_STUDENTS = 'bench_students'
+GRADE = 2
+RESPONSE_ADAPTER = TypeAdapter(List[StudentGradeCounts])
+
+
+def make_rows(size: int):
+    rnd = random.Random(size)
+    return [(i, *(rnd.randint(0, 10) for _ in range(5))) for i in range(1, size + 1)]
+
+
+def make_students(size: int):
+    return [(i, f'Студент {i}') for i in range(1, size + 1)]
+
+
+def stats_query() -> str:
+    query, _ = build_grade_counts_query(GRADE, None, None, None)
+    return query.replace('student_grade_stats', BENCH_TABLE).replace('JOIN students ', f'JOIN {BENCH_STUDENTS} ')
+
+
+async def run_models(conn: asyncpg.Connection) -> bytes:
+    # прежний путь: модель на строку, повторная проверка по response_model и jsonable_encoder + json.dumps
+    rows = await conn.fetch(stats_query(), None, None, None)
+    students = [StudentGradeCounts(**row) for row in rows]
+    validated = RESPONSE_ADAPTER.validate_python(students)
+    return json.dumps(jsonable_encoder(validated), ensure_ascii=False).encode()
+
+
+async def run_orjson(conn: asyncpg.Connection) -> bytes:
+    rows = await conn.fetch(stats_query(), None, None, None)
+    return orjson.dumps([dict(row) for row in rows])
+
+
+async def run_json_agg(conn: asyncpg.Connection) -> bytes:
+    # вариант с JSON, собранным в Postgres
+    query = f'''
+        SELECT COALESCE(json_agg(page ORDER BY count_{GRADE} DESC, full_name ASC), '[]')
+        FROM ({stats_query()}) page
+    '''
+    body = await conn.fetchval(query, None, None, None)
+    return body.encode()
+
+
+async def measure(conn: asyncpg.Connection, method, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await method(conn)
+        best = min(best, time.perf_counter() - started)
+    return 1 / best
+
+
+async def main(sizes, repeat: int) -> None:
+    settings = get_settings()
+    conn = await asyncpg.connect(
+        host = settings.DB_HOST,
+        port = settings.DB_PORT,
+        user = settings.DB_USER,
+        password = settings.DB_PASSWORD,
+        database = settings.DB_NAME,
+    )
+    try:
+        await conn.execute(f'DROP TABLE IF EXISTS {BENCH_TABLE}, {BENCH_STUDENTS}')
+        await conn.execute(f'CREATE TABLE {BENCH_TABLE} (LIKE student_grade_stats INCLUDING ALL)')
+        await conn.execute(f'CREATE TABLE {BENCH_STUDENTS} (LIKE students INCLUDING ALL)')
+        print(f'{"rows":>10} {"models resp/s":>14} {"orjson resp/s":>14} {"json_agg resp/s":>16} {"speedup":>8}')
+        for size in sizes:
+            await conn.execute(f'TRUNCATE {BENCH_TABLE}, {BENCH_STUDENTS}')
+            await conn.copy_records_to_table(BENCH_STUDENTS, records=make_students(size), columns=['id', 'full_name'])
+            await conn.copy_records_to_table(BENCH_TABLE, records=make_rows(size), columns=['student_id', 'count_1', 'count_2', 'count_3', 'count_4', 'count_5'])
+            await conn.execute(f'ANALYZE {BENCH_TABLE}, {BENCH_STUDENTS}')
+            models = await measure(conn, run_models, repeat)
+            fast = await measure(conn, run_orjson, repeat)
+            agg = await measure(conn, run_json_agg, repeat)
+            print(f'{size:>10} {models:>14.1f} {fast:>14.1f} {agg:>16.1f} {fast / models:>7.1f}x')
+    finally:
+        await conn.execute(f'DROP TABLE IF EXISTS {BENCH_TABLE}, {BENCH_STUDENTS}')
+        await conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ответ со списком студентов: pydantic-модели против orjson и json_agg')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes, args.repeat))
@@ -0,0 +1,81 @@
+# python -m benchmarks.bench_validation --sizes 1000 10000 100000
+import argparse
+import csv
+import io
+import random
+import time
+from app.schemas import GradeRecord
+from app.utils.columnar import pa, parse_record_batch
+from app.utils.validators import parse_columns
+
+
+COLUMNS = {'Дата': 0, 'Номер группы': 1, 'ФИО': 2, 'Оценка': 3}
+
+
+def make_lines(size: int):
+    rnd = random.Random(size)
+    return [f'01.09.2025;Группа {rnd.randrange(50)};Студент {rnd.randrange(size // 10 + 1)};{rnd.randint(1, 5)}\n' for _ in range(size)]
+
+
+def parse_per_row(lines, columns, first_row_num):
+    # прежний путь: модель GradeRecord на каждую строку, потом обратно в кортеж
+    rows = []
+    errors = []
+    for row_num, row in enumerate(csv.reader(lines, delimiter=';'), start=first_row_num):
+        try:
+            record = GradeRecord(
+                full_name=row[columns['ФИО']].strip(),
+                subject=row[columns['Номер группы']].strip(),
+                grade=int(row[columns['Оценка']])
+            )
+            rows.append((record.full_name, record.subject, record.grade))
+        except (ValueError, IndexError) as e:
+            errors.append(f'Строка {row_num}: {str(e)}')
+    return rows, errors
+
+
+def to_record_batch(lines):
+    # те же строки, записанные в parquet и прочитанные обратно: дата и оценка уже типизированы
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+    table = pa_csv.read_csv(
+        io.BytesIO(''.join(lines).encode()),
+        read_options=pa_csv.ReadOptions(column_names=list(COLUMNS)),
+        parse_options=pa_csv.ParseOptions(delimiter=';'),
+        convert_options=pa_csv.ConvertOptions(timestamp_parsers=['%d.%m.%Y']),
+    )
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    return pq.read_table(buffer).combine_chunks().to_batches()[0]
+
+
+def parse_arrow(batch, columns, first_row_num):
+    return parse_record_batch(batch, first_row_num - 1)
+
+
+def measure(parse, lines, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        parse(lines, COLUMNS, 2)
+        best = min(best, time.perf_counter() - started)
+    return len(lines) / best if isinstance(lines, list) else lines.num_rows / best
+
+
+def main(sizes, repeat: int) -> None:
+    # последняя колонка - проверка Parquet/Arrow (нужен pyarrow): без разбора текста и int()
+    print(f'{"rows":>10} {"per-row rows/s":>16} {"columnar rows/s":>17} {"speedup":>8} {"arrow rows/s":>14} {"speedup":>8}')
+    for size in sizes:
+        lines = make_lines(size)
+        per_row = measure(parse_per_row, lines, repeat)
+        columnar = measure(parse_columns, lines, repeat)
+        arrow = measure(parse_arrow, to_record_batch(lines), repeat) if pa is not None else float('nan')
+        print(f'{size:>10} {per_row:>16.0f} {columnar:>17.0f} {columnar / per_row:>7.1f}x {arrow:>14.0f} {arrow / per_row:>7.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='валидация CSV: GradeRecord на строку против колоночной')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    main(args.sizes, args.repeat)
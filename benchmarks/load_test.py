@@ -0,0 +1,193 @@
+# python -m benchmarks.load_test --sizes 1000 10000 --save-baseline benchmarks/baseline.json
+# python -m benchmarks.load_test --sizes 1000 10000 --baseline benchmarks/baseline.json --threshold 0.2
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import sys
+import time
+from contextlib import AsyncExitStack
+from datetime import date, timedelta
+from typing import Dict, List, Optional
+import httpx
+
+
+HEADER = 'Дата;Номер группы;ФИО;Оценка'
+ANALYTICS_ENDPOINTS = ('/api/students/more-than-3-twos', '/api/students/less-than-5-twos')
+# чем больше значение, тем лучше; остальные метрики (задержки, память) лучше меньше
+HIGHER_IS_BETTER = ('rows_per_second', 'requests_per_second')
+
+
+def make_csv(size: int, seed: int) -> bytes:
+    rnd = random.Random(seed)
+    students = size // 10 + 1
+    start = date(2025, 9, 1)
+    lines = [HEADER]
+    for _ in range(size):
+        day = start + timedelta(days=rnd.randrange(150))
+        lines.append(f'{day:%d.%m.%Y};{rnd.randrange(100, 150)};Студент {rnd.randrange(students)};{rnd.randint(2, 5)}')
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def percentile(values: List[float], q: float) -> float:
+    # ближайший ранг: p99 на сотне замеров - самый медленный, без интерполяции
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def summarize(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    return {
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'requests_per_second': len(latencies) / elapsed,
+    }
+
+
+def peak_rss_mb(pid: Optional[int]) -> float:
+    if pid is None:
+        # ru_maxrss в Linux в килобайтах
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    raise ValueError(f'VmHWM не найден для процесса {pid}')
+
+
+async def run_concurrently(total: int, concurrency: int, request) -> tuple:
+    # concurrency клиентов разбирают общую очередь из total запросов
+    latencies: List[float] = []
+    counter = iter(range(total))
+
+    async def client() -> None:
+        for i in counter:
+            started = time.perf_counter()
+            await request(i)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - started
+
+
+async def bench_upload(client: httpx.AsyncClient, size: int, uploads: int, concurrency: int, seed: int) -> Dict[str, float]:
+    # у каждой загрузки свой файл: одинаковые отсёк бы журнал загрузок
+    files = [make_csv(size, seed + i) for i in range(uploads)]
+
+    async def request(i: int) -> None:
+        response = await client.post(
+            '/api/upload-grades', files={'file': (f'bench_{size}_{i}.csv', files[i], 'text/csv')}
+        )
+        if response.status_code != 200 or response.json()['status'] != 'ok':
+            raise RuntimeError(f'Загрузка {size} строк: {response.status_code} {response.text[:200]}')
+
+    latencies, elapsed = await run_concurrently(uploads, concurrency, request)
+    result = summarize(latencies, elapsed)
+    result['rows_per_second'] = size * uploads / elapsed
+    return result
+
+
+async def bench_analytics(client: httpx.AsyncClient, path: str, requests: int, concurrency: int) -> Dict[str, float]:
+    async def request(i: int) -> None:
+        response = await client.get(path)
+        if response.status_code != 200:
+            raise RuntimeError(f'{path}: {response.status_code} {response.text[:200]}')
+
+    latencies, elapsed = await run_concurrently(requests, concurrency, request)
+    return summarize(latencies, elapsed)
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    regressions = []
+    for scenario, metrics in baseline['scenarios'].items():
+        for metric, old in metrics.items():
+            new = current['scenarios'].get(scenario, {}).get(metric)
+            if new is None or not old:
+                continue
+            change = (old - new) / old if metric in HIGHER_IS_BETTER else (new - old) / old
+            if change > threshold:
+                regressions.append(f'{scenario} {metric}: {old:.1f} -> {new:.1f} ({change:+.0%})')
+    old, new = baseline['peak_rss_mb'], current['peak_rss_mb']
+    if old and (new - old) / old > threshold:
+        regressions.append(f'peak_rss_mb: {old:.1f} -> {new:.1f} ({(new - old) / old:+.0%})')
+    return regressions
+
+
+async def main(args) -> int:
+    async with AsyncExitStack() as stack:
+        if args.url:
+            client = await stack.enter_async_context(httpx.AsyncClient(base_url=args.url, timeout=args.timeout))
+        else:
+            # приложение в этом же процессе, с lifespan: пул бд, секции, пул парсинга
+            from app.main import app, lifespan
+            await stack.enter_async_context(lifespan(app))
+            transport = httpx.ASGITransport(app=app)
+            client = await stack.enter_async_context(
+                httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=args.timeout)
+            )
+        # прогрев: первый файл поднимает пул парсинга и готовит запросы на соединениях
+        await bench_upload(client, 10, args.concurrency, args.concurrency, args.seed)
+        scenarios = {}
+        for size in args.sizes:
+            scenarios[f'upload_{size}'] = await bench_upload(client, size, args.uploads, args.concurrency, args.seed + size)
+        for path in ANALYTICS_ENDPOINTS:
+            scenarios[path.rsplit('/', 1)[-1]] = await bench_analytics(client, path, args.requests, args.concurrency)
+
+    current = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {
+            'sizes': args.sizes, 'uploads': args.uploads, 'requests': args.requests,
+            'concurrency': args.concurrency, 'cache': args.cache, 'url': args.url,
+        },
+        'scenarios': scenarios,
+        'peak_rss_mb': peak_rss_mb(args.pid),
+    }
+    print(f'{"scenario":>22} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"req/s":>9} {"rows/s":>10}')
+    for name, result in scenarios.items():
+        rows = f'{result["rows_per_second"]:>10.0f}' if 'rows_per_second' in result else f'{"-":>10}'
+        print(
+            f'{name:>22} {result["p50_ms"]:>9.1f} {result["p95_ms"]:>9.1f} {result["p99_ms"]:>9.1f} '
+            f'{result["requests_per_second"]:>9.1f} {rows}'
+        )
+    print(f'peak RSS: {current["peak_rss_mb"]:.1f} MB')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        print(f'baseline сохранён в {args.save_baseline}')
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f'регрессия больше {args.threshold:.0%}:')
+            for line in regressions:
+                print(f'  {line}')
+            return 1
+        print(f'регрессий больше {args.threshold:.0%} нет')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='нагрузочный прогон загрузки и аналитики с порогом регрессии')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--uploads', type=int, default=8, help='загрузок на каждый размер')
+    parser.add_argument('--requests', type=int, default=200, help='запросов на каждый эндпоинт аналитики')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--url', help='уже запущенный сервер; без него приложение поднимается в этом процессе')
+    parser.add_argument('--pid', type=int, help='pid сервера для peak RSS при --url')
+    parser.add_argument('--cache', action='store_true', help='не отключать кэш аналитики (только без --url)')
+    parser.add_argument('--baseline', help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--save-baseline', help='куда сохранить результаты прогона')
+    parser.add_argument('--threshold', type=float, default=0.2, help='допустимое ухудшение, доля')
+    args = parser.parse_args()
+    if not args.url and not args.cache:
+        # иначе аналитика после первого запроса отвечает из кэша и бд не нагружается
+        os.environ['ANALYTICS_CACHE_SIZE'] = '0'
+    sys.exit(asyncio.run(main(args)))
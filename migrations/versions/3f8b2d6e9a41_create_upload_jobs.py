@@ -0,0 +1,27 @@
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+revision = '3f8b2d6e9a41'
+down_revision = '7c1e4a9d2f60'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'upload_jobs',
+        sa.Column('id', sa.String(32), primary_key=True),
+        sa.Column('filename', sa.String(255), nullable=False),
+        sa.Column('status', sa.String(16), nullable=False),
+        sa.Column('rows_parsed', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('rows_inserted', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('students', sa.Integer(), nullable=True),
+        sa.Column('errors', postgresql.ARRAY(sa.Text()), nullable=False, server_default='{}'),
+        sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+    )
+
+def downgrade():
+    op.drop_table('upload_jobs')
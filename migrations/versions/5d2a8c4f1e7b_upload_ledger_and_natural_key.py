@@ -0,0 +1,31 @@
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '5d2a8c4f1e7b'
+down_revision = '3f8b2d6e9a41'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # дата раньше не сохранялась, у старых строк она остаётся NULL и в естественный ключ не попадает
+    op.add_column('grades', sa.Column('grade_date', sa.Date(), nullable=True))
+    op.create_index(
+        'uq_grades_natural_key',
+        'grades',
+        ['grade_date', 'subject', 'full_name'],
+        unique=True
+    )
+    op.create_table(
+        'upload_ledger',
+        sa.Column('content_hash', sa.String(64), primary_key=True),
+        sa.Column('filename', sa.String(255), nullable=False),
+        sa.Column('records_loaded', sa.Integer(), nullable=False),
+        sa.Column('students', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+    )
+
+def downgrade():
+    op.drop_table('upload_ledger')
+    op.drop_index('uq_grades_natural_key', table_name='grades')
+    op.drop_column('grades', 'grade_date')
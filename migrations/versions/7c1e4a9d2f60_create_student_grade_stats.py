@@ -0,0 +1,40 @@
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '7c1e4a9d2f60'
+down_revision = 'abc123'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'student_grade_stats',
+        sa.Column('full_name', sa.String(255), primary_key=True),
+        sa.Column('count_1', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('count_2', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('count_3', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('count_4', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('count_5', sa.Integer(), nullable=False, server_default='0'),
+    )
+    op.create_index(
+        'idx_student_grade_stats_twos',
+        'student_grade_stats',
+        [sa.text('count_2 DESC'), 'full_name'],
+        postgresql_where=sa.text('count_2 > 0'),
+    )
+    op.execute('''
+        INSERT INTO student_grade_stats (full_name, count_1, count_2, count_3, count_4, count_5)
+        SELECT
+            full_name,
+            COUNT(*) FILTER (WHERE grade = 1),
+            COUNT(*) FILTER (WHERE grade = 2),
+            COUNT(*) FILTER (WHERE grade = 3),
+            COUNT(*) FILTER (WHERE grade = 4),
+            COUNT(*) FILTER (WHERE grade = 5)
+        FROM grades
+        GROUP BY full_name
+    ''')
+
+def downgrade():
+    op.drop_table('student_grade_stats')
@@ -0,0 +1,76 @@
+from datetime import date
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '8e3f1b6c4a2d'
+down_revision = '5d2a8c4f1e7b'
+branch_labels = None
+depends_on = None
+
+INDEXES = (
+    ('idx_grades_full_name', 'full_name'),
+    ('idx_grades_grade', 'grade'),
+    ('idx_grades_subject', 'subject'),
+    ('idx_grades_full_name_grade', 'full_name, grade'),
+    ('idx_grades_grade_date', 'grade_date'),
+)
+
+
+def term_start(day):
+    # семестры как в app/services/partitions.py: с 1 сентября и с 1 февраля
+    if day.month >= 9:
+        return date(day.year, 9, 1)
+    if day.month >= 2:
+        return date(day.year, 2, 1)
+    return date(day.year - 1, 9, 1)
+
+
+def next_term_start(start):
+    if start.month == 9:
+        return date(start.year + 1, 2, 1)
+    return date(start.year, 9, 1)
+
+
+def upgrade():
+    bind = op.get_bind()
+    first, last = bind.execute(sa.text('SELECT min(grade_date), max(grade_date) FROM grades')).one()
+    today = date.today()
+    first = min(first or today, today)
+    last = next_term_start(term_start(max(last or today, today)))
+
+    op.execute('ALTER TABLE grades RENAME TO grades_unpartitioned')
+    # LIKE переносит колонки, default с последовательностью id и check на оценку;
+    # первичный ключ на секционированной таблице обязан включать дату, а она бывает NULL, поэтому его нет
+    op.execute('''
+        CREATE TABLE grades (LIKE grades_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+        PARTITION BY RANGE (grade_date)
+    ''')
+    op.execute('ALTER SEQUENCE grades_id_seq OWNED BY grades.id')
+    start = term_start(first)
+    while start <= last:
+        end = next_term_start(start)
+        op.execute(
+            f"CREATE TABLE grades_p{start.year}_{start.month:02d} PARTITION OF grades "
+            f"FOR VALUES FROM ('{start}') TO ('{end}')"
+        )
+        start = end
+    # строки без даты и за пределами созданных семестров
+    op.execute('CREATE TABLE grades_default PARTITION OF grades DEFAULT')
+    op.execute('INSERT INTO grades SELECT * FROM grades_unpartitioned')
+    op.execute('DROP TABLE grades_unpartitioned')
+    for name, columns in INDEXES:
+        op.execute(f'CREATE INDEX {name} ON grades ({columns})')
+    op.execute('CREATE UNIQUE INDEX uq_grades_natural_key ON grades (grade_date, subject, full_name)')
+
+
+def downgrade():
+    op.execute('ALTER TABLE grades RENAME TO grades_partitioned')
+    op.execute('CREATE TABLE grades (LIKE grades_partitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+    op.execute('ALTER SEQUENCE grades_id_seq OWNED BY grades.id')
+    op.execute('INSERT INTO grades SELECT * FROM grades_partitioned')
+    op.execute('DROP TABLE grades_partitioned')
+    op.execute('ALTER TABLE grades ADD PRIMARY KEY (id)')
+    for name, columns in INDEXES[:-1]:
+        op.execute(f'CREATE INDEX {name} ON grades ({columns})')
+    op.execute('CREATE UNIQUE INDEX uq_grades_natural_key ON grades (grade_date, subject, full_name)')
@@ -0,0 +1,31 @@
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'b7d41e9a3c58'
+down_revision = '8e3f1b6c4a2d'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table(
+        'students',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('full_name', sa.String(255), nullable=False, unique=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+    )
+    # одна строка со счётчиком различных студентов, чтобы не считать их по grades на каждой загрузке
+    op.create_table(
+        'student_counter',
+        sa.Column('id', sa.SmallInteger(), primary_key=True, server_default='1'),
+        sa.Column('total', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.CheckConstraint('id = 1'),
+    )
+    op.execute('INSERT INTO students (full_name) SELECT DISTINCT full_name FROM grades ORDER BY full_name')
+    op.execute('INSERT INTO student_counter (id, total) SELECT 1, COUNT(*) FROM students')
+    op.add_column('upload_jobs', sa.Column('file_students', sa.Integer(), nullable=True))
+
+def downgrade():
+    op.drop_column('upload_jobs', 'file_students')
+    op.drop_table('student_counter')
+    op.drop_table('students')
@@ -0,0 +1,131 @@
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'c4e9a7b2d1f3'
+down_revision = 'b7d41e9a3c58'
+branch_labels = None
+depends_on = None
+
+ID_COLUMNS = '''
+    id INTEGER NOT NULL DEFAULT nextval('grades_id_seq'),
+    student_id INTEGER NOT NULL,
+    group_id INTEGER NOT NULL,
+    grade SMALLINT NOT NULL,
+    grade_date DATE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+'''
+
+NAME_COLUMNS = '''
+    id INTEGER NOT NULL DEFAULT nextval('grades_id_seq'),
+    full_name VARCHAR(255) NOT NULL,
+    subject VARCHAR(255) NOT NULL,
+    grade INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    grade_date DATE
+'''
+NAME_INDEXES = (
+    ('idx_grades_full_name', 'full_name'),
+    ('idx_grades_grade', 'grade'),
+    ('idx_grades_subject', 'subject'),
+    ('idx_grades_full_name_grade', 'full_name, grade'),
+    ('idx_grades_grade_date', 'grade_date'),
+)
+
+
+def rebuild_grades(columns, select, indexes, natural_key):
+    # таблица пересоздаётся целиком, а не через DROP COLUMN: место строк освобождается сразу,
+    # секции переносятся с теми же именами и границами
+    bind = op.get_bind()
+    partitions = bind.execute(sa.text('''
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'grades'::regclass
+        ORDER BY c.relname
+    ''')).all()
+    checks = bind.execute(sa.text('''
+        SELECT conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = 'grades'::regclass AND contype = 'c'
+    ''')).all()
+
+    op.execute('ALTER TABLE grades RENAME TO grades_old')
+    for name, _ in partitions:
+        op.execute(f'ALTER TABLE {name} RENAME TO {name}_old')
+    op.execute(f'CREATE TABLE grades ({columns}) PARTITION BY RANGE (grade_date)')
+    op.execute('ALTER SEQUENCE grades_id_seq OWNED BY grades.id')
+    for name, check in checks:
+        op.execute(f'ALTER TABLE grades ADD CONSTRAINT {name} {check}')
+    for name, bound in partitions:
+        op.execute(f'CREATE TABLE {name} PARTITION OF grades {bound}')
+    op.execute(select)
+    op.execute('DROP TABLE grades_old')
+    for name, index_columns in indexes:
+        op.execute(f'CREATE INDEX {name} ON grades ({index_columns})')
+    op.execute(f'CREATE UNIQUE INDEX uq_grades_natural_key ON grades ({natural_key})')
+
+
+def upgrade():
+    op.create_table(
+        'groups',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('name', sa.String(255), nullable=False, unique=True),
+    )
+    op.execute('INSERT INTO groups (name) SELECT DISTINCT subject FROM grades ORDER BY subject')
+    rebuild_grades(
+        ID_COLUMNS,
+        '''
+        INSERT INTO grades (id, student_id, group_id, grade, grade_date, created_at)
+        SELECT g.id, s.id, gr.id, g.grade, g.grade_date, g.created_at
+        FROM grades_old g
+        JOIN students s ON s.full_name = g.full_name
+        JOIN groups gr ON gr.name = g.subject
+        ''',
+        # вторичные индексы по новым колонкам подбирает следующая миграция, здесь только естественный ключ
+        (),
+        'grade_date, group_id, student_id',
+    )
+
+    # таблица счётчиков - строка на студента, её достаточно перевести на ключ student_id на месте
+    op.add_column('student_grade_stats', sa.Column('student_id', sa.Integer(), nullable=True))
+    op.execute('UPDATE student_grade_stats st SET student_id = s.id FROM students s WHERE s.full_name = st.full_name')
+    op.drop_index('idx_student_grade_stats_twos', table_name='student_grade_stats')
+    op.drop_constraint('student_grade_stats_pkey', 'student_grade_stats')
+    op.drop_column('student_grade_stats', 'full_name')
+    op.create_primary_key('student_grade_stats_pkey', 'student_grade_stats', ['student_id'])
+    op.create_index(
+        'idx_student_grade_stats_twos',
+        'student_grade_stats',
+        [sa.text('count_2 DESC'), 'student_id'],
+        postgresql_where=sa.text('count_2 > 0'),
+    )
+
+
+def downgrade():
+    op.add_column('student_grade_stats', sa.Column('full_name', sa.String(255), nullable=True))
+    op.execute('UPDATE student_grade_stats st SET full_name = s.full_name FROM students s WHERE s.id = st.student_id')
+    op.drop_index('idx_student_grade_stats_twos', table_name='student_grade_stats')
+    op.drop_constraint('student_grade_stats_pkey', 'student_grade_stats')
+    op.drop_column('student_grade_stats', 'student_id')
+    op.create_primary_key('student_grade_stats_pkey', 'student_grade_stats', ['full_name'])
+    op.create_index(
+        'idx_student_grade_stats_twos',
+        'student_grade_stats',
+        [sa.text('count_2 DESC'), 'full_name'],
+        postgresql_where=sa.text('count_2 > 0'),
+    )
+
+    rebuild_grades(
+        NAME_COLUMNS,
+        '''
+        INSERT INTO grades (id, full_name, subject, grade, created_at, grade_date)
+        SELECT g.id, s.full_name, gr.name, g.grade, g.created_at, g.grade_date
+        FROM grades_old g
+        JOIN students s ON s.id = g.student_id
+        JOIN groups gr ON gr.id = g.group_id
+        ''',
+        NAME_INDEXES,
+        'grade_date, subject, full_name',
+    )
+    op.drop_table('groups')
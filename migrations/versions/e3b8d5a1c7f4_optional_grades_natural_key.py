@@ -0,0 +1,25 @@
+from alembic import op
+from app.config import get_settings
+
+
+revision = 'e3b8d5a1c7f4'
+down_revision = 'd1a6f3c8b5e2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # уникальный ключ (дата, группа, студент) нужен только слиянию GRADES_ON_CONFLICT=update/ignore.
+    # при append у студента бывает несколько оценок за день в группе, ключ остаётся обычным индексом для выборок по датам
+    if get_settings().GRADES_ON_CONFLICT != 'append':
+        return
+    op.create_index('idx_grades_natural_key', 'grades', ['grade_date', 'group_id', 'student_id'])
+    op.drop_index('uq_grades_natural_key', table_name='grades')
+
+
+def downgrade():
+    # после append в таблице могут быть повторы ключа: уникальный индекс тогда не создастся, их нужно убрать вручную
+    if get_settings().GRADES_ON_CONFLICT != 'append':
+        return
+    op.create_index('uq_grades_natural_key', 'grades', ['grade_date', 'group_id', 'student_id'], unique=True)
+    op.drop_index('idx_grades_natural_key', table_name='grades')
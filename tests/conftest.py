@@ -3,6 +3,7 @@ import asyncio
 import asyncpg
 from app.main import app
 from app.database import init_db, close_db, execute_update
+from app.services.analytics_cache import analytics_cache
 from fastapi.testclient import TestClient
 
 
@@ -19,16 +20,66 @@ async def setup_test_db():
     create_table_query = '''
         DROP TABLE IF EXISTS grades CASCADE;
         CREATE TABLE grades (
-            id SERIAL PRIMARY KEY,
-            full_name VARCHAR(255) NOT NULL,
-            subject VARCHAR(255) NOT NULL,
-            grade INTEGER NOT NULL CHECK (grade >= 1 AND grade <= 5),
+            id SERIAL,
+            student_id INTEGER NOT NULL,
+            group_id INTEGER NOT NULL,
+            grade SMALLINT NOT NULL CHECK (grade >= 1 AND grade <= 5),
+            grade_date DATE,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) PARTITION BY RANGE (grade_date);
+        CREATE TABLE grades_default PARTITION OF grades DEFAULT;
+        CREATE INDEX idx_grades_group_id_grade_date ON grades(group_id, grade_date) INCLUDE (student_id, grade);
+        CREATE INDEX idx_grades_twos ON grades(student_id) INCLUDE (grade_date, group_id) WHERE grade = 2;
+        CREATE INDEX idx_grades_natural_key ON grades(grade_date, group_id, student_id);
+        DROP TABLE IF EXISTS student_grade_stats CASCADE;
+        CREATE TABLE student_grade_stats (
+            student_id INTEGER PRIMARY KEY,
+            count_1 INTEGER NOT NULL DEFAULT 0,
+            count_2 INTEGER NOT NULL DEFAULT 0,
+            count_3 INTEGER NOT NULL DEFAULT 0,
+            count_4 INTEGER NOT NULL DEFAULT 0,
+            count_5 INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX idx_student_grade_stats_twos ON student_grade_stats(count_2 DESC, student_id) WHERE count_2 > 0;
+        DROP TABLE IF EXISTS upload_jobs CASCADE;
+        CREATE TABLE upload_jobs (
+            id VARCHAR(32) PRIMARY KEY,
+            filename VARCHAR(255) NOT NULL,
+            status VARCHAR(16) NOT NULL,
+            rows_parsed INTEGER NOT NULL DEFAULT 0,
+            rows_inserted INTEGER NOT NULL DEFAULT 0,
+            students INTEGER,
+            errors TEXT[] NOT NULL DEFAULT '{}',
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            file_students INTEGER
+        );
+        DROP TABLE IF EXISTS upload_ledger CASCADE;
+        CREATE TABLE upload_ledger (
+            content_hash VARCHAR(64) PRIMARY KEY,
+            filename VARCHAR(255) NOT NULL,
+            records_loaded INTEGER NOT NULL,
+            students INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        DROP TABLE IF EXISTS students CASCADE;
+        CREATE TABLE students (
+            id SERIAL PRIMARY KEY,
+            full_name VARCHAR(255) NOT NULL UNIQUE,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        DROP TABLE IF EXISTS student_counter CASCADE;
+        CREATE TABLE student_counter (
+            id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+            total BIGINT NOT NULL DEFAULT 0
+        );
+        INSERT INTO student_counter (id, total) VALUES (1, 0);
+        DROP TABLE IF EXISTS groups CASCADE;
+        CREATE TABLE groups (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(255) NOT NULL UNIQUE
         );
-        CREATE INDEX idx_grades_full_name ON grades(full_name);
-        CREATE INDEX idx_grades_grade ON grades(grade);
-        CREATE INDEX idx_grades_subject ON grades(subject);
-        CREATE INDEX idx_grades_full_name_grade ON grades(full_name, grade);
     '''
     try:
         for query in create_table_query.split(';'):
@@ -47,6 +98,17 @@ def client():
 
 @pytest.fixture
 async def clean_db():
-    await execute_update("TRUNCATE TABLE grades RESTART IDENTITY")
+    await execute_update("TRUNCATE TABLE grades, student_grade_stats, upload_ledger, students, groups RESTART IDENTITY")
+    await execute_update("UPDATE student_counter SET total = 0")
+    analytics_cache.invalidate()
+    yield
+    await execute_update("TRUNCATE TABLE grades, student_grade_stats, upload_ledger, students, groups RESTART IDENTITY")
+    await execute_update("UPDATE student_counter SET total = 0")
+
+
+@pytest.fixture
+async def natural_key(monkeypatch):
+    # слияние update/ignore: уникальный индекс ключа, как его создаёт миграция при этих значениях GRADES_ON_CONFLICT
+    await execute_update("CREATE UNIQUE INDEX uq_grades_natural_key ON grades(grade_date, group_id, student_id)")
     yield
-    await execute_update("TRUNCATE TABLE grades RESTART IDENTITY")
\ No newline at end of file
+    await execute_update("DROP INDEX uq_grades_natural_key")
@@ -1,8 +1,20 @@
+import asyncio
 import io
+import logging
+import time
+import zipfile
 import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from fastapi.testclient import TestClient
-from app.main import app
+from app import database, metrics
 from app.database import execute_update
+from app.logger import LOGGER_NAME
+from app.main import RequestMetricsMiddleware, app
+from app.services.analytics_cache import analytics_cache
+from app.schemas import GradeRecord
+from app.services.grade_service import GradeService
+from app.utils.pagination import encode_cursor
 
 
 @pytest.fixture
@@ -95,30 +107,12 @@ async def test_upload_grades_csv_with_extra_spaces(client, clean_db):
 
 @pytest.mark.asyncio
 async def test_get_students_with_more_than_3_twos(client, clean_db):
-    await execute_update(
-        "INSERT INTO grades (full_name, subject, grade) VALUES ($1, $2, $3)",
-        "Иванов Иван", "Предмет1", 2
-    )
-    await execute_update(
-        "INSERT INTO grades (full_name, subject, grade) VALUES ($1, $2, $3)",
-        "Иванов Иван", "Предмет2", 2
-    )
-    await execute_update(
-        "INSERT INTO grades (full_name, subject, grade) VALUES ($1, $2, $3)",
-        "Иванов Иван", "Предмет3", 2
-    )
-    await execute_update(
-        "INSERT INTO grades (full_name, subject, grade) VALUES ($1, $2, $3)",
-        "Иванов Иван", "Предмет4", 2
-    )
-    await execute_update(
-        "INSERT INTO grades (full_name, subject, grade) VALUES ($1, $2, $3)",
-        "Петров Пётр", "Предмет1", 2
-    )
-    await execute_update(
-        "INSERT INTO grades (full_name, subject, grade) VALUES ($1, $2, $3)",
-        "Петров Пётр", "Предмет2", 2
-    )
+    await GradeService.insert_grades([GradeRecord(full_name="Иванов Иван", subject="Предмет1", grade=2)])
+    await GradeService.insert_grades([GradeRecord(full_name="Иванов Иван", subject="Предмет2", grade=2)])
+    await GradeService.insert_grades([GradeRecord(full_name="Иванов Иван", subject="Предмет3", grade=2)])
+    await GradeService.insert_grades([GradeRecord(full_name="Иванов Иван", subject="Предмет4", grade=2)])
+    await GradeService.insert_grades([GradeRecord(full_name="Петров Пётр", subject="Предмет1", grade=2)])
+    await GradeService.insert_grades([GradeRecord(full_name="Петров Пётр", subject="Предмет2", grade=2)])
     
     response = client.get("/api/students/more-than-3-twos")
     assert response.status_code == 200
@@ -130,14 +124,8 @@ async def test_get_students_with_more_than_3_twos(client, clean_db):
 
 @pytest.mark.asyncio
 async def test_get_students_with_more_than_3_twos_no_results(client, clean_db):
-    await execute_update(
-        "INSERT INTO grades (full_name, subject, grade) VALUES ($1, $2, $3)",
-        "Иванов Иван", "Предмет1", 2
-    )
-    await execute_update(
-        "INSERT INTO grades (full_name, subject, grade) VALUES ($1, $2, $3)",
-        "Иванов Иван", "Предмет2", 2
-    )
+    await GradeService.insert_grades([GradeRecord(full_name="Иванов Иван", subject="Предмет1", grade=2)])
+    await GradeService.insert_grades([GradeRecord(full_name="Иванов Иван", subject="Предмет2", grade=2)])
     response = client.get("/api/students/more-than-3-twos")
     assert response.status_code == 200
     data = response.json()
@@ -147,16 +135,10 @@ async def test_get_students_with_more_than_3_twos_no_results(client, clean_db):
 @pytest.mark.asyncio
 async def test_get_students_with_less_than_5_twos(client, clean_db):
     for i in range(2):
-        await execute_update(
-            "INSERT INTO grades (full_name, subject, grade) VALUES ($1, $2, $3)",
-            "Иванов Иван", f"Предмет{i}", 2
-        )
+        await GradeService.insert_grades([GradeRecord(full_name="Иванов Иван", subject=f"Предмет{i}", grade=2)])
     
     for i in range(4):
-        await execute_update(
-            "INSERT INTO grades (full_name, subject, grade) VALUES ($1, $2, $3)",
-            "Петров Пётр", f"Предмет{i}", 2
-        )
+        await GradeService.insert_grades([GradeRecord(full_name="Петров Пётр", subject=f"Предмет{i}", grade=2)])
     
     response = client.get("/api/students/less-than-5-twos")
     assert response.status_code == 200
@@ -177,10 +159,7 @@ async def test_get_students_with_less_than_5_twos_all_records(client, clean_db):
     
     for student, count in test_data:
         for i in range(count):
-            await execute_update(
-                "INSERT INTO grades (full_name, subject, grade) VALUES ($1, $2, $3)",
-                student, f"Предмет{i}", 2
-            )
+            await GradeService.insert_grades([GradeRecord(full_name=student, subject=f"Предмет{i}", grade=2)])
     
     response = client.get("/api/students/less-than-5-twos")
     
@@ -191,18 +170,10 @@ async def test_get_students_with_less_than_5_twos_all_records(client, clean_db):
 
 
 @pytest.mark.asyncio
-    await execute_update(
-        "INSERT INTO grades (full_name, subject, grade) VALUES ($1, $2, $3)",
-        "Иванов Иван", "Математика", 5
-    )
-    await execute_update(
-        "INSERT INTO grades (full_name, subject, grade) VALUES ($1, $2, $3)",
-        "Иванов Иван", "Русский язык", 4
-    )
-    await execute_update(
-        "INSERT INTO grades (full_name, subject, grade) VALUES ($1, $2, $3)",
-        "Петров Пётр", "Математика", 3
-    )
+async def test_get_stats(client, clean_db):
+    await GradeService.insert_grades([GradeRecord(full_name="Иванов Иван", subject="Математика", grade=5)])
+    await GradeService.insert_grades([GradeRecord(full_name="Иванов Иван", subject="Русский язык", grade=4)])
+    await GradeService.insert_grades([GradeRecord(full_name="Петров Пётр", subject="Математика", grade=3)])
     
     response = client.get("/api/stats")
     
@@ -313,3 +284,294 @@ async def test_upload_csv_with_long_names(client, clean_db):
     response = client.post("/api/upload-grades", files=files)
     assert response.status_code == 200
     assert response.json()["records_loaded"] == 1
+
+
+HEADER = "Дата;Номер группы;ФИО;Оценка\n"
+
+
+@pytest.fixture(scope="module")
+def api():
+    # приложение целиком, с lifespan: пул бд, очередь фоновых загрузок и пул парсинга живут в цикле TestClient,
+    # общий пул тестов из цикла pytest на это время откладывается
+    # setup_logging отключает передачу записей корневому логгеру, caplog в других модулях их бы не увидел
+    logger = logging.getLogger(LOGGER_NAME)
+    pool, level, propagate = database._pool, logger.level, logger.propagate
+    with TestClient(app) as client:
+        yield client
+    database._pool = pool
+    logger.setLevel(level)
+    logger.propagate = propagate
+
+
+@pytest.fixture
+def api_client(api):
+    # очистка через цикл TestClient: его пул из цикла pytest не использовать
+    async def truncate():
+        await execute_update("TRUNCATE TABLE grades, student_grade_stats, upload_ledger, upload_jobs, students, groups RESTART IDENTITY")
+        await execute_update("UPDATE student_counter SET total = 0")
+        analytics_cache.invalidate()
+
+    api.portal.call(truncate)
+    return api
+
+
+def upload(client, content: str, filename: str = "grades.csv", **params):
+    files = {"file": (filename, io.BytesIO(content.encode()), "text/csv")}
+    return client.post("/api/upload-grades", files=files, params=params)
+
+
+def wait_for_job(client, job_id: str, timeout: float = 20.0) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(f"/api/upload-jobs/{job_id}").json()
+        if job["status"] not in ("queued", "running") or time.monotonic() > deadline:
+            return job
+        time.sleep(0.05)
+
+
+@pytest.mark.asyncio
+async def test_async_upload_returns_job_and_reports_progress(api_client):
+    content = HEADER + "01.09.2025;101;Иванов Иван;2\n02.09.2025;101;Иванов Иван;5\n01.09.2025;102;Петров Пётр;3\n"
+    response = upload(api_client, content, mode="async")
+    assert response.status_code == 202
+    data = response.json()
+    assert data["status"] == "queued"
+    assert data["filename"] == "grades.csv"
+    assert set(data) >= {"job_id", "rows_parsed", "rows_inserted", "errors", "created_at"}
+    job = wait_for_job(api_client, data["job_id"])
+    assert job["status"] == "done"
+    assert (job["rows_inserted"], job["students"], job["file_students"], job["errors"]) == (3, 2, 2, [])
+    assert job["finished_at"] is not None
+
+
+@pytest.mark.asyncio
+async def test_async_upload_invalid_rows_fail_job(api_client):
+    response = upload(api_client, HEADER + "01.09.2025;101;Иванов Иван;7\n", mode="async")
+    assert response.status_code == 202
+    job = wait_for_job(api_client, response.json()["job_id"])
+    assert job["status"] == "failed"
+    assert job["rows_inserted"] == 0
+    assert "Строка 2" in job["errors"][0]
+
+
+@pytest.mark.asyncio
+async def test_async_upload_rejects_bad_input(api_client):
+    response = upload(api_client, HEADER, filename="grades.txt", mode="async")
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Только csv файлы"
+    assert upload(api_client, HEADER, mode="later").status_code == 422
+    response = api_client.get("/api/upload-jobs/unknown")
+    assert response.status_code == 404
+    assert response.json()["detail"] == "Задача загрузки не найдена"
+
+
+GRADES_CSV = HEADER + "".join(
+    f"0{day}.09.2025;{group};{name};{grade}\n"
+    for day, group, name, grade in [
+        (1, 101, "Иванов Иван", 2), (2, 101, "Иванов Иван", 2), (3, 101, "Иванов Иван", 5),
+        (1, 102, "Петров Пётр", 2), (2, 102, "Петров Пётр", 4),
+        (1, 101, "Сидоров Сидор", 3),
+    ]
+)
+
+
+@pytest.mark.asyncio
+async def test_grade_counts_route(api_client):
+    assert upload(api_client, GRADES_CSV).status_code == 200
+    response = api_client.get("/api/students/grade-counts")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert response.json() == [
+        {"full_name": "Иванов Иван", "count_1": 0, "count_2": 2, "count_3": 0, "count_4": 0, "count_5": 1, "total": 3},
+        {"full_name": "Петров Пётр", "count_1": 0, "count_2": 1, "count_3": 0, "count_4": 1, "count_5": 0, "total": 2},
+        {"full_name": "Сидоров Сидор", "count_1": 0, "count_2": 0, "count_3": 1, "count_4": 0, "count_5": 0, "total": 1},
+    ]
+    response = api_client.get("/api/students/grade-counts", params={"grade": 5, "min": 1})
+    assert [row["full_name"] for row in response.json()] == ["Иванов Иван"]
+    response = api_client.get("/api/students/grade-counts", params={"group": "101", "from": "2025-09-02", "to": "2025-09-03"})
+    assert [(row["full_name"], row["total"]) for row in response.json()] == [("Иванов Иван", 2)]
+
+
+@pytest.mark.asyncio
+async def test_grade_counts_route_rejects_bad_input(api_client):
+    for grade in (0, 6):
+        assert api_client.get("/api/students/grade-counts", params={"grade": grade}).status_code == 422
+    assert api_client.get("/api/students/grade-counts", params={"from": "1 сентября"}).status_code == 422
+    assert api_client.get("/api/students/grade-counts", params={"limit": 0}).status_code == 422
+    response = api_client.get("/api/students/grade-counts", params={"cursor": "не курсор"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Некорректный курсор"
+
+
+@pytest.mark.asyncio
+async def test_paging_returns_next_cursor(api_client):
+    assert upload(api_client, GRADES_CSV).status_code == 200
+    response = api_client.get("/api/students/grade-counts", params={"limit": 2})
+    assert [row["full_name"] for row in response.json()] == ["Иванов Иван", "Петров Пётр"]
+    cursor = response.headers["X-Next-Cursor"]
+    response = api_client.get("/api/students/grade-counts", params={"limit": 2, "cursor": cursor})
+    assert [row["full_name"] for row in response.json()] == ["Сидоров Сидор"]
+    assert "X-Next-Cursor" not in response.headers
+
+    response = api_client.get("/api/students/less-than-5-twos", params={"limit": 1})
+    assert response.json() == [{"full_name": "Иванов Иван", "twos_count": 2}]
+    response = api_client.get("/api/students/less-than-5-twos", params={"limit": 1, "cursor": response.headers["X-Next-Cursor"]})
+    assert response.json() == [{"full_name": "Петров Пётр", "twos_count": 1}]
+
+
+@pytest.mark.asyncio
+async def test_ndjson_respects_limit(api_client):
+    assert upload(api_client, GRADES_CSV).status_code == 200
+    response = api_client.get("/api/students/less-than-5-twos", params={"format": "ndjson", "limit": 1})
+    assert response.status_code == 200
+    assert response.text.splitlines() == ['{"full_name":"Иванов Иван","twos_count":2}']
+    response = api_client.get("/api/students/grade-counts", params={"format": "ndjson", "limit": 2})
+    assert len(response.text.splitlines()) == 2
+
+
+@pytest.mark.asyncio
+async def test_cursor_out_of_int4_range_rejected(api_client):
+    for count in (2 ** 31, -1, True):
+        cursor = encode_cursor(count, "Иванов Иван")
+        for path in ("/api/students/grade-counts", "/api/students/more-than-3-twos"):
+            response = api_client.get(path, params={"cursor": cursor})
+            assert response.status_code == 400
+            assert response.json()["detail"] == "Некорректный курсор"
+
+
+def upload_batch(client, *files):
+    return client.post("/api/upload-grades/batch", files=[("files", (name, io.BytesIO(content), "application/octet-stream")) for name, content in files])
+
+
+@pytest.mark.asyncio
+async def test_batch_upload_route(api_client):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("101/ivanov.csv", HEADER + "01.09.2025;101;Иванов Иван;2\n02.09.2025;101;Иванов Иван;2\n")
+        zf.writestr("101/petrov.csv", HEADER + "01.09.2025;101;Петров Пётр;4\n")
+    extra = (HEADER + "01.09.2025;102;Сидоров Сидор;3\n").encode()
+    files = [("group101.zip", archive.getvalue()), ("extra.csv", extra), ("copy.csv", extra)]
+    response = upload_batch(api_client, *files)
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["status"], data["records_loaded"], data["students"], data["file_students"]) == ("ok", 4, 3, 3)
+    statuses = {file["filename"]: (file["status"], file["records"]) for file in data["files"]}
+    # второй такой же файл в запросе помечается дублем, а не откатывает пакет
+    assert statuses == {
+        "group101.zip/101/ivanov.csv": ("ok", 2),
+        "group101.zip/101/petrov.csv": ("ok", 1),
+        "extra.csv": ("ok", 1),
+        "copy.csv": ("duplicate", 0),
+    }
+    assert all(len(file["content_hash"]) == 64 for file in data["files"])
+
+    response = upload_batch(api_client, *files)
+    assert response.status_code == 200
+    assert (response.json()["status"], response.json()["records_loaded"]) == ("duplicate", 0)
+
+
+@pytest.mark.asyncio
+async def test_batch_upload_route_rejects_bad_input(api_client):
+    response = upload_batch(api_client, ("grades.txt", b"x"))
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("grades.txt: только csv файлы")
+
+    response = upload_batch(api_client, ("broken.zip", b"not a zip"))
+    assert response.status_code == 400
+    assert response.json()["detail"] == "broken.zip: Архив повреждён"
+
+    good = (HEADER + "01.09.2025;101;Иванов Иван;2\n").encode()
+    bad = (HEADER + "01.09.2025;101;Петров Пётр;7\n").encode()
+    response = upload_batch(api_client, ("good.csv", good), ("bad.csv", bad))
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("bad.csv: ")
+    # пакет откатывается целиком: хороший файл тоже не загружен
+    assert api_client.get("/api/students/grade-counts").json() == []
+
+    assert api_client.post("/api/upload-grades/batch").status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_export_csv_routes(api_client):
+    assert upload(api_client, GRADES_CSV).status_code == 200
+    response = api_client.get("/api/export/grades")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert response.headers["content-disposition"] == 'attachment; filename="grades.csv"'
+    header, *rows = response.text.splitlines()
+    # выгрузка в формате загрузки, порядок строк не задан
+    assert header + "\n" == HEADER
+    assert sorted(rows) == sorted(GRADES_CSV.splitlines()[1:])
+
+    response = api_client.get("/api/export/grades", params={"group": "102", "from": "2025-09-02"})
+    assert response.text.splitlines()[1:] == ["02.09.2025;102;Петров Пётр;4"]
+
+    response = api_client.get("/api/export/student-stats")
+    assert response.status_code == 200
+    assert response.headers["content-disposition"] == 'attachment; filename="student-stats.csv"'
+    header, *rows = response.text.splitlines()
+    assert header == "full_name;count_1;count_2;count_3;count_4;count_5;total"
+    assert sorted(rows) == ["Иванов Иван;0;2;0;0;1;3", "Петров Пётр;0;1;0;1;0;2", "Сидоров Сидор;0;0;1;0;0;1"]
+
+
+@pytest.mark.asyncio
+async def test_export_parquet_route(api_client):
+    pq = pytest.importorskip("pyarrow.parquet")
+    assert upload(api_client, GRADES_CSV).status_code == 200
+    response = api_client.get("/api/export/student-stats", params={"format": "parquet", "group": "101"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/vnd.apache.parquet"
+    assert response.headers["content-disposition"] == 'attachment; filename="student-stats.parquet"'
+    rows = sorted(pq.read_table(io.BytesIO(response.content)).to_pylist(), key=lambda row: row["full_name"])
+    assert [(row["full_name"], row["count_2"], row["total"]) for row in rows] == [("Иванов Иван", 2, 3), ("Сидоров Сидор", 0, 1)]
+
+    response = api_client.get("/api/export/grades", params={"format": "parquet"})
+    assert response.status_code == 200
+    assert pq.read_table(io.BytesIO(response.content)).num_rows == 6
+
+
+@pytest.mark.asyncio
+async def test_export_routes_reject_bad_input(api_client, monkeypatch):
+    for path in ("/api/export/grades", "/api/export/student-stats"):
+        assert api_client.get(path, params={"format": "xml"}).status_code == 422
+        assert api_client.get(path, params={"from": "01.09.2025"}).status_code == 422
+        assert api_client.get(path, params={"group": ""}).status_code == 422
+    monkeypatch.setattr("app.utils.columnar.pa", None)
+    response = api_client.get("/api/export/grades", params={"format": "parquet"})
+    assert response.status_code == 406
+    assert response.json()["detail"] == "Parquet недоступен: не установлен пакет pyarrow"
+    # csv от pyarrow не зависит
+    assert api_client.get("/api/export/grades").status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_request_metrics_cover_streamed_body():
+    async def body():
+        for _ in range(3):
+            await asyncio.sleep(0.1)
+            yield b"x"
+
+    slow = FastAPI()
+    slow.add_middleware(RequestMetricsMiddleware)
+
+    @slow.get("/slow/{name}")
+    async def stream(name: str):
+        return StreamingResponse(body())
+
+    assert TestClient(slow).get("/slow/a").text == "xxx"
+    # в гистограмме время до последнего байта тела, а не до заголовков
+    sample = f'http_request_duration_seconds_sum{{method="GET",path="/slow/{{name}}",status="200"}} '
+    line = next(line for line in metrics.render_metrics().splitlines() if line.startswith(sample))
+    assert float(line[len(sample):]) >= 0.3
+
+
+@pytest.mark.asyncio
+async def test_twos_routes_filter_by_from_to(api_client):
+    assert upload(api_client, GRADES_CSV).status_code == 200
+    params = {"from": "2025-09-02", "to": "2025-09-03"}
+    response = api_client.get("/api/students/less-than-5-twos", params=params)
+    assert response.status_code == 200
+    assert response.json() == [{"full_name": "Иванов Иван", "twos_count": 1}]
+    response = api_client.get("/api/students/less-than-5-twos", params={**params, "format": "ndjson"})
+    assert response.text.splitlines() == ['{"full_name":"Иванов Иван","twos_count":1}']
+    assert api_client.get("/api/students/more-than-3-twos", params={"from": "2 сентября"}).status_code == 422
@@ -0,0 +1,286 @@
+import gzip
+import io
+import tempfile
+from datetime import date, datetime
+import pytest
+from fastapi import UploadFile
+from starlette.datastructures import Headers
+from app.config import get_settings
+from app.utils import executors
+from app.utils.columnar import iter_columnar_batches
+from app.utils.compression import iter_upload_content, upload_encoding
+from app.utils.validators import iter_grade_batches
+
+
+HEADER = 'Дата;Номер группы;ФИО;Оценка\n'
+
+
+async def make_chunks(content: bytes, size: int):
+    for start in range(0, len(content), size):
+        yield content[start:start + size]
+
+
+async def collect(content: bytes, chunk_size: int = 3, batch_size: int = 2):
+    batches = []
+    async for batch in iter_grade_batches(make_chunks(content, chunk_size), batch_size):
+        batches.append(batch)
+    return batches
+
+
+@pytest.mark.asyncio
+async def test_stream_batches_with_bom_and_split_chars():
+    csv_content = '\ufeff' + HEADER + '01.09.2025;101;Ёжиков Ёж;5\n01.09.2025;101;Юрьев Юрий;2\n01.09.2025;102;Петров Пётр;3'
+    batches = await collect(csv_content.encode('utf-8'))
+    assert [len(batch.grade) for batch in batches] == [2, 1]
+    assert (batches[0].full_name[0], batches[0].subject[0], batches[0].grade[0]) == ('Ёжиков Ёж', '101', 5)
+    assert batches[1].grade == [3]
+
+
+@pytest.mark.asyncio
+async def test_stream_quoted_field_with_newline():
+    csv_content = HEADER + '01.09.2025;"10\n1";Иванов Иван;4\n'
+    batches = await collect(csv_content.encode('utf-8'), chunk_size=1)
+    assert batches[0].subject == ['10\n1']
+
+
+@pytest.mark.asyncio
+async def test_stream_stray_quote_does_not_glue_records():
+    csv_content = HEADER + '01.09.2025;101;O"Brien Пат;5\n01.09.2025;101;Иванов Иван;4\n01.09.2025;"10\n2";Петров Пётр;3\n'
+    batches = await collect(csv_content.encode('utf-8'), chunk_size=5, batch_size=10)
+    assert batches[0].full_name == ['O"Brien Пат', 'Иванов Иван', 'Петров Пётр']
+    assert batches[0].subject == ['101', '101', '10\n2']
+
+
+@pytest.mark.asyncio
+async def test_stream_csv_error_reported_with_row_number():
+    csv_content = HEADER + '01.09.2025;101;Иванов Иван;5\n01.09.2025;101;"' + 'x' * 200000 + '";5\n'
+    with pytest.raises(ValueError, match='Строка 3: некорректная строка csv'):
+        await collect(csv_content.encode('utf-8'), chunk_size=4096)
+
+
+@pytest.mark.asyncio
+async def test_stream_missing_columns():
+    with pytest.raises(ValueError, match='Нет необходимых колонок'):
+        await collect('ФИО;Оценка\nИванов Иван;5'.encode('utf-8'))
+
+
+@pytest.mark.asyncio
+async def test_stream_errors_abort_upload():
+    csv_content = HEADER + '01.09.2025;101;Иванов Иван;5\n01.09.2025;101;Петров Пётр;10\n'
+    with pytest.raises(ValueError, match='Строка 3'):
+        await collect(csv_content.encode('utf-8'))
+
+
+@pytest.mark.asyncio
+async def test_stream_grade_only_ascii_digits():
+    csv_content = HEADER + '01.09.2025;101;Иванов Иван;+4\n01.09.2025;101;Петров Пётр;²\n01.09.2025;101;Сидоров Сидор;４\n'
+    with pytest.raises(ValueError, match='Строка 3: оценка должна быть целым числом;Строка 4: оценка должна быть целым числом'):
+        await collect(csv_content.encode('utf-8'))
+    batches = await collect((HEADER + '01.09.2025;101;Иванов Иван;+4\n').encode('utf-8'))
+    assert batches[0].grade == [4]
+
+
+@pytest.mark.asyncio
+async def test_stream_overlong_fields_rejected_before_vectorizing():
+    csv_content = HEADER + (
+        '01.09.2025;101;' + 'Я' * 100000 + ';5\n'
+        '01.09.2025;101;Иванов Иван;' + '5' * 300 + '\n'
+        '01.09.2025;101;' + ' ' * 100000 + 'Петров Пётр;4\n'
+    )
+    with pytest.raises(ValueError) as error:
+        await collect(csv_content.encode('utf-8'), chunk_size=4096, batch_size=10)
+    assert str(error.value).endswith(
+        'Строка 2: ФИО должно быть от 1 до 255 символов;Строка 3: оценка должна быть целым числом'
+    )
+    # пробелы вокруг значения не считаются в длину, как и без обрезки
+    batches = await collect((HEADER + '01.09.2025;101;' + ' ' * 100000 + 'Петров Пётр;4\n').encode('utf-8'), chunk_size=4096)
+    assert batches[0].full_name == ['Петров Пётр']
+
+
+@pytest.mark.asyncio
+async def test_stream_records_limit(monkeypatch):
+    monkeypatch.setattr(get_settings(), 'MAX_RECORDS_PER_FILE', 2)
+    csv_content = HEADER + '01.09.2025;101;Иванов Иван;5\n' * 3
+    with pytest.raises(ValueError, match='Количество записей'):
+        await collect(csv_content.encode('utf-8'))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('executor', ['process', 'thread', 'inline'])
+async def test_parallel_blocks_keep_order_and_row_numbers(monkeypatch, executor):
+    monkeypatch.setattr(get_settings(), 'PARSE_EXECUTOR', executor)
+    executors.shutdown_parse_executor()
+    lines = [f'01.09.2025;101;Студент {i};{i % 5 + 1}\n' for i in range(50)]
+    lines.insert(10, '\n')
+    batches = await collect((HEADER + ''.join(lines)).encode('utf-8'), chunk_size=64, batch_size=7)
+    assert [name for batch in batches for name in batch.full_name] == [f'Студент {i}' for i in range(50)]
+    bad = lines[:30] + ['01.09.2025;101;Студент;0\n'] + lines[30:]
+    with pytest.raises(ValueError, match='Строка 31:'):
+        await collect((HEADER + ''.join(bad)).encode('utf-8'), chunk_size=64, batch_size=7)
+    executors.shutdown_parse_executor()
+
+
+@pytest.mark.asyncio
+async def test_ingest_logs_summary_instead_of_rows(caplog, capsys):
+    csv_content = HEADER + '01.09.2025;101;Иванов Иван;4\n' * 3 + '01.09.2025;101;Петров Пётр;7\n' * 10
+    with caplog.at_level('INFO', logger='app.ingest'):
+        with pytest.raises(ValueError):
+            await collect(csv_content.encode('utf-8'), chunk_size=64, batch_size=4)
+    assert capsys.readouterr().out == ''
+    [record] = caplog.records
+    assert record.fields['records'] == 13
+    assert record.fields['invalid_rows'] == 10
+    assert len(record.fields['sample_errors']) == 5
+
+
+async def collect_upload(file: UploadFile, encoding, chunk_size: int = 64):
+    names = []
+    async for batch in iter_grade_batches(iter_upload_content(file, encoding, chunk_size), 3):
+        names.extend(batch.full_name)
+    return names
+
+
+def test_upload_encoding_from_header_or_suffix():
+    assert upload_encoding('grades.csv') is None
+    assert upload_encoding('grades.csv.gz') == 'gzip'
+    assert upload_encoding('grades.csv', 'gzip') == 'gzip'
+    assert upload_encoding('grades.csv.gz', 'identity') is None
+    with pytest.raises(ValueError, match='Неподдерживаемое сжатие'):
+        upload_encoding('grades.csv', 'br')
+
+
+@pytest.mark.asyncio
+async def test_gzip_upload_decoded_incrementally():
+    lines = [f'01.09.2025;101;Студент {i};{i % 5 + 1}\n' for i in range(20)]
+    # два gzip-члена подряд тоже один поток
+    content = gzip.compress((HEADER + ''.join(lines[:7])).encode()) + gzip.compress(''.join(lines[7:]).encode())
+    file = UploadFile(io.BytesIO(content), filename='grades.csv', headers=Headers({'content-encoding': 'gzip'}))
+    assert await collect_upload(file, upload_encoding(file.filename, file.headers.get('content-encoding'))) == [
+        f'Студент {i}' for i in range(20)
+    ]
+    with pytest.raises(ValueError, match='Сжатый файл повреждён'):
+        await collect_upload(UploadFile(io.BytesIO(content[:40]), filename='grades.csv.gz'), 'gzip')
+
+
+@pytest.mark.asyncio
+async def test_zstd_upload_decoded_incrementally():
+    zstandard = pytest.importorskip('zstandard')
+    content = zstandard.ZstdCompressor().compress((HEADER + '01.09.2025;101;Иванов Иван;5\n').encode())
+    assert await collect_upload(UploadFile(io.BytesIO(content), filename='grades.csv.zst'), 'zstd') == ['Иванов Иван']
+
+
+@pytest.mark.asyncio
+async def test_compressed_size_limit_applies_to_decoded_stream(monkeypatch):
+    monkeypatch.setattr(get_settings(), 'NAX_FILE_SIZE', 64 * 1024)
+    # ~60 КБ сжатых данных разворачиваются в 10 МБ, распаковка обрывается на первых 64 КБ
+    content = gzip.compress((HEADER + '01.09.2025;101;Иванов Иван;5\n' * 300000).encode())
+    assert len(content) < get_settings().NAX_FILE_SIZE
+    with pytest.raises(ValueError, match='Размер файла превышает'):
+        await collect_upload(UploadFile(io.BytesIO(content), filename='grades.csv.gz'), 'gzip', chunk_size=4096)
+
+
+async def collect_columnar(source, kind: str = 'parquet', batch_size: int = 2):
+    batches = []
+    async for batch in iter_columnar_batches(source, kind, batch_size):
+        batches.append(batch)
+    return batches
+
+
+@pytest.mark.asyncio
+async def test_parquet_columns_validated_like_csv():
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    table = pa.table({
+        'full_name': [' Иванов Иван ', 'Петров Пётр', 'Иванов Иван'],
+        'subject': pa.array([101, 102, 101], pa.int32()),
+        'grade': [5.0, 2.0, 3.0],
+        'grade_date': [datetime(2025, 9, 1, 10), datetime(2025, 9, 2), datetime(2025, 9, 3)],
+    })
+    # файл больше порога SpooledTemporaryFile уже на диске и читается через mmap
+    spooled = tempfile.SpooledTemporaryFile(max_size=1)
+    pq.write_table(table, spooled)
+    spooled.seek(0)
+    batches = await collect_columnar(spooled)
+    assert [batch.full_name.dictionary.to_pylist() for batch in batches] == [['Иванов Иван', 'Петров Пётр'], ['Иванов Иван']]
+    assert [batch.subject.dictionary.to_pylist() for batch in batches] == [['101', '102'], ['101']]
+    assert [batch.grade.to_pylist() for batch in batches] == [[5, 2], [3]]
+    assert batches[1].grade_date.to_pylist() == [date(2025, 9, 3)]
+
+    bad = pa.table({
+        'Дата': ['01.09.2025', '2025-09-02', '31.02.2025', '01.09.2025'],
+        'Номер группы': ['101', '101', '101', ''],
+        'ФИО': ['Иванов Иван', 'Петров Пётр', 'Сидоров Сидор', None],
+        'Оценка': ['5', '7', '4', 'пять'],
+    })
+    buffer = io.BytesIO()
+    pq.write_table(bad, buffer)
+    with pytest.raises(ValueError) as error:
+        await collect_columnar(buffer)
+    assert str(error.value) == (
+        'На стадии парсинга ошибки (3): Строка 2: оценка должна быть от 1 до 5;'
+        'Строка 3: дата должна быть в формате ДД.ММ.ГГГГ;'
+        'Строка 4: ФИО должно быть от 1 до 255 символов, Номер группы должен быть от 1 до 255 символов, оценка должна быть целым числом'
+    )
+
+
+@pytest.mark.asyncio
+async def test_parquet_text_grades_in_memory_upload():
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+
+    def spooled(grades):
+        # файл меньше порога SpooledTemporaryFile ещё в памяти
+        file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        pq.write_table(pa.table({
+            'Дата': ['01.09.2025'] * len(grades),
+            'Номер группы': ['101'] * len(grades),
+            'ФИО': ['Иванов Иван'] * len(grades),
+            'Оценка': grades,
+        }), file)
+        return file
+
+    batches = await collect_columnar(spooled(['+4', ' 5', '2']))
+    assert [batch.grade.to_pylist() for batch in batches] == [[4, 5], [2]]
+    # как и в csv, цифры только 0-9
+    with pytest.raises(ValueError) as error:
+        await collect_columnar(spooled(['²', '４']))
+    assert str(error.value) == (
+        'На стадии парсинга ошибки (2): Строка 1: оценка должна быть целым числом;'
+        'Строка 2: оценка должна быть целым числом'
+    )
+
+
+@pytest.mark.asyncio
+async def test_arrow_ipc_file_and_stream(monkeypatch):
+    pa = pytest.importorskip('pyarrow')
+    table = pa.table({
+        'Дата': pa.array([date(2025, 9, 1)] * 5, pa.date32()),
+        'Номер группы': ['101'] * 5,
+        'ФИО': [f'Студент {i}' for i in range(5)],
+        'Оценка': pa.array([1, 2, 3, 4, 5], pa.int8()),
+    })
+    for open_writer in (pa.ipc.new_file, pa.ipc.new_stream):
+        sink = pa.BufferOutputStream()
+        with open_writer(sink, table.schema) as writer:
+            writer.write_table(table)
+        batches = await collect_columnar(io.BytesIO(sink.getvalue().to_pybytes()), 'arrow', batch_size=3)
+        assert [len(batch.grade) for batch in batches] == [3, 2]
+    monkeypatch.setattr(get_settings(), 'MAX_RECORDS_PER_FILE', 4)
+    with pytest.raises(ValueError, match='Количество записей'):
+        await collect_columnar(io.BytesIO(sink.getvalue().to_pybytes()), 'arrow')
+
+
+@pytest.mark.asyncio
+async def test_parquet_export_cuts_blocks_on_whole_rows():
+    pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    from app.utils.columnar import iter_parquet
+    content = ''.join(f'2025-09-{1 + i % 28:02d};"Студент\n{i}";{1 + i % 5}\n' for i in range(100)).encode()
+    columns = [('Дата', 'date32'), ('ФИО', 'string'), ('Оценка', 'int16')]
+    # блок больше куска COPY, но меньше всего csv: перевод строки в кавычках не режет строку пополам
+    parts = [part async for part in iter_parquet(make_chunks(content, 7), columns, 256)]
+    parquet = pq.ParquetFile(io.BytesIO(b''.join(parts)))
+    assert parquet.metadata.num_row_groups > 1
+    rows = parquet.read().to_pylist()
+    assert len(rows) == 100
+    assert rows[99] == {'Дата': date(2025, 9, 16), 'ФИО': 'Студент\n99', 'Оценка': 5}